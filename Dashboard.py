@@ -1,43 +1,147 @@
 # Load default libraries
 import streamlit as st
 
-from lib.GraphDB import GraphDB
-from lib.Visualizer import Visualizer
+# The neo4j driver, pandas, PyVis and SciPy are imported once they are needed,
+# so the page is drawn before they are loaded
+from lib.QueryCache import QueryCache
+from lib.RequestTrace import RequestTrace
 
 # Load configuration
 import yaml
 from yaml.loader import SafeLoader
 
-import pandas as pd
-import numpy as np
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from functools import partial
+
+@st.cache_resource
+def get_query_cache(max_entries: int, ttl_seconds: float, max_megabytes: float) -> QueryCache:
+    # One result cache per process, shared by all browser sessions
+    return QueryCache(
+        max_entries=max_entries,
+        ttl_seconds=ttl_seconds,
+        max_bytes=int(max_megabytes * 1024 * 1024)
+        )
+
+@st.cache_resource
+def get_analytics_engine(source: str, datadir: str, _graph_db) -> "AnalyticsEngine":
+    # Nodes and edges are loaded into memory once per process, Clear Cache loads them again
+    from lib.AnalyticsEngine import AnalyticsEngine
+
+    if source == "graph":
+        return AnalyticsEngine.from_graph(_graph_db)
+    return AnalyticsEngine.from_processed(datadir)
+
+@st.cache_resource
+def get_connection_executor() -> ThreadPoolExecutor:
+    # New sessions connect on their own threads, they never wait behind running queries or page prefetches
+    return ThreadPoolExecutor(max_workers=4, thread_name_prefix="connect")
+
+@st.cache_resource
+def get_graph_preparation(uri: str, database: str) -> dict:
+    # The constraints, indexes and summaries are checked once per process and database by the first
+    # session that connects, the others reuse its index usage and schema errors
+    return {"lock": threading.Lock(), "result": None}
+
+def connect(config: dict, cache: QueryCache, preparation: dict) -> tuple:
+    # Runs on a background thread while the page is drawn: import the driver, check the connection
+    # and prepare the graph if no session of this process did so yet
+    from lib.GraphDB import GraphDB
+
+    db = GraphDB(
+        uri=config["DATABASE"]["URI"], 
+        user=config["DATABASE"]["USER"], 
+        password=config["DATABASE"]["PASSWORD"], 
+        database=config["DATABASE"]["DBNAME"],
+        cache=cache,
+        pool_config={
+            "max_connection_pool_size": config["DATABASE"]["POOL"]["MAX_CONNECTION_POOL_SIZE"],
+            "connection_acquisition_timeout": config["DATABASE"]["POOL"]["CONNECTION_ACQUISITION_TIMEOUT"],
+            "max_connection_lifetime": config["DATABASE"]["POOL"]["MAX_CONNECTION_LIFETIME"]
+            }
+        )
+    # The dashboard works without the schema, a failure is shown as a warning instead of stopping the app
+    try:
+        with preparation["lock"]:
+            if preparation["result"] is None:
+                index_usage = db.ensure_schema(
+                    queries={
+                        example_query["key"]: example_query["query"]
+                        for example_query in config["EXAMPLE_QUERIES"].values()
+                        }
+                    )
+                preparation["result"] = (index_usage, list(db.schema_errors))
+        index_usage, warnings = preparation["result"]
+    except Exception as e:
+        index_usage, warnings = {}, [str(e)]
+    return db, index_usage, warnings
+
+def current_trace(request: str) -> RequestTrace | None:
+    # Both tabs render on every run, only the tab that made the request adds to its trace
+    trace = st.session_state.pending_trace
+    return trace if trace is not None and trace.name == request else None
+
+def trace_stage(request: str, name: str, **details):
+    # Time a stage of the request being traced, does nothing when no request is traced
+    trace = current_trace(request)
+    return nullcontext() if trace is None else trace.stage(name, **details)
 
 try:
     if "config" not in st.session_state:
         with open('config.yaml') as config_file:
             st.session_state.config = yaml.load(config_file, Loader=SafeLoader)
 
-    if "db" not in st.session_state:
-        st.session_state.db = GraphDB(
-            uri=st.session_state.config["DATABASE"]["URI"], 
-            user=st.session_state.config["DATABASE"]["USER"], 
-            password=st.session_state.config["DATABASE"]["PASSWORD"], 
-            database=st.session_state.config["DATABASE"]["DBNAME"]
+    if "connection" not in st.session_state:
+        st.session_state.db = None
+        st.session_state.index_usage = {}
+        st.session_state.schema_warnings = []
+        st.session_state.connection = get_connection_executor().submit(
+            connect,
+            st.session_state.config,
+            get_query_cache(
+                max_entries=st.session_state.config["CACHE"]["MAX_ENTRIES"],
+                ttl_seconds=st.session_state.config["CACHE"]["TTL_SECONDS"],
+                max_megabytes=st.session_state.config["CACHE"]["MAX_MEGABYTES"]
+                ),
+            get_graph_preparation(
+                st.session_state.config["DATABASE"]["URI"],
+                st.session_state.config["DATABASE"]["DBNAME"]
+                )
             )
         
-    if "visualizer" not in st.session_state:
-        st.session_state.visualizer = Visualizer()
-        
     if "graph_results" not in st.session_state:
         st.session_state.graph_results = None
+        st.session_state.graph_results_key = None
+        st.session_state.query_job = None
+        st.session_state.query_pager = None
         
     if "graph_database" not in st.session_state:
         st.session_state.graph_database = None
-        st.session_state.graph_size = None
+        st.session_state.graph_database_key = None
+        st.session_state.graph_pager = None
         
+    if "pending_trace" not in st.session_state:
+        st.session_state.pending_trace = None
+        st.session_state.last_trace = None
+        
+    if "scenario" not in st.session_state:
+        st.session_state.scenario = None
+        st.session_state.scenario_report = None
+
     if "example_loaded" not in st.session_state:
         st.session_state.example_loaded = ""
         st.session_state.example_key = ""
 
+    # Pick up the connection once the background check is done, a failed connection is
+    # dropped so the next run of the page connects again
+    connection = st.session_state.connection
+    if st.session_state.db is None and connection.done():
+        if connection.exception() is not None:
+            del st.session_state.connection
+        st.session_state.db, st.session_state.index_usage, st.session_state.schema_warnings = connection.result()
+
 except Exception as e:
     st.error(st.session_state.config["MESSAGES"]["ERRORS"]["START"])
     st.error(e)
@@ -47,7 +151,51 @@ st.set_page_config(
     page_title="Graph Dashboard"
 )
 
-tab1, tab2 = st.tabs(["Query", "Full Graph"])
+connected = st.session_state.db is not None
+if connected:
+    # The neo4j driver already loaded pandas and numpy, so these are cheap once connected
+    import numpy as np
+    import pandas as pd
+
+    from lib.AnalyticsEngine import AnalyticsEngine
+    from lib.GraphDB import GraphDB, TABULAR_QUERIES
+    from lib.Pager import Pager
+    from lib.Visualizer import Visualizer
+
+    if "visualizer" not in st.session_state:
+        st.session_state.visualizer = Visualizer()
+
+with st.sidebar:
+    if not connected:
+        st.info("Connecting to the knowledge graph...")
+    else:
+        for warning in st.session_state.schema_warnings:
+            st.warning(f"{st.session_state.config['MESSAGES']['WARNINGS']['SCHEMA']} {warning}")
+
+        st.subheader("Query Cache")
+        cache_stats = st.session_state.db.cache.stats()
+        col1, col2 = st.columns(2)
+        col1.metric("Hits", cache_stats["hits"])
+        col2.metric("Misses", cache_stats["misses"])
+        col1.metric("Entries", cache_stats["entries"])
+        col2.metric("Size (MB)", round(cache_stats["size_bytes"] / (1024 * 1024), 2))
+        if st.button("Clear Cache"):
+            st.session_state.db.cache.invalidate()
+            get_analytics_engine.clear()
+            st.session_state.scenario = None
+            st.session_state.scenario_report = None
+            st.rerun()
+
+        st.subheader("Connection Pool")
+        pool_stats = st.session_state.db.pool_stats()
+        col1, col2 = st.columns(2)
+        col1.metric("In Use", pool_stats.get("in_use"))
+        col2.metric("Idle", pool_stats.get("idle"))
+        col1.metric("Avg Wait (ms)", pool_stats.get("avg_wait_ms"))
+        col2.metric("Max Wait (ms)", pool_stats.get("max_wait_ms"))
+        st.caption(f"Sessions sharing the pool: {pool_stats.get('references')}")
+
+tab1, tab2, tab3 = st.tabs(["Query", "Full Graph", "Scenarios"])
 
 with tab1:
     st.header("Run Queries")
@@ -59,6 +207,8 @@ with tab1:
             example_query = st.session_state.config["EXAMPLE_QUERIES"][query_key]
             st.write(example_query["description"])
             st.code(example_query["query"])
+            indexes_used = st.session_state.index_usage.get(example_query["key"], [])
+            st.caption(f"Indexes used: {', '.join(indexes_used) if len(indexes_used) > 0 else 'none'}")
             if st.button("Load", key=example_query["key"]):
                 st.session_state.example_loaded = example_query["query"]
                 st.session_state.example_key = example_query["key"]
@@ -75,33 +225,148 @@ with tab1:
     query_limit = st.slider(
             label="Limit the number of relationships to display", 
             min_value=1, 
-            max_value=1000, 
-            value=25
+            max_value=1000,
+            value=25,
+            help="Queries returning a named relationship are paged, this is the size of a page."
             )
     
-    if st.button("Run Query"):
-        st.session_state.graph_results = st.session_state.db.run_query(
-            query = query_input,
-            query_limit = query_limit,
-            example_key=st.session_state.example_key
+    profile_query = st.checkbox(
+        label="Profile query",
+        value=False,
+        help="Run the query with PROFILE to capture the plan and db hits in the Performance panel, it bypasses the cache."
+        )
+    
+    if st.button("Run Query", disabled=not connected):
+        # Only one query runs per session, stop the previous one before starting the next
+        if st.session_state.query_job is not None and not st.session_state.query_job.done():
+            st.session_state.query_job.cancel()
+            st.session_state.query_job = None
+
+        trace = RequestTrace("query", example_key=st.session_state.example_key, limit=query_limit, profile=profile_query)
+        
+        # Unchanged example queries are answered from memory when the analytics engine is enabled
+        analytics = st.session_state.config["ANALYTICS"]
+        use_engine = (
+            analytics["ENABLED"] and not profile_query
+            and AnalyticsEngine.ANSWERS.get(st.session_state.example_key) is not None
+            and QueryCache.normalize(query_input) == QueryCache.normalize(st.session_state.example_loaded)
+            )
+        
+        st.session_state.query_pager = None
+        if use_engine:
+            try:
+                with trace.stage("analytics engine"):
+                    engine = get_analytics_engine(analytics["SOURCE"], analytics["DATADIR"], st.session_state.db)
+                    rows = engine.run_query(st.session_state.example_key, query_limit)
+                st.session_state.pending_trace = trace
+                
+                # The same frames as run_query_frame returns
+                with trace_stage("query", "pandas"):
+                    st.session_state.graph_results = GraphDB.result_frames([rows], st.session_state.example_key)
+                st.session_state.graph_results_key = Visualizer.fingerprint(st.session_state.graph_results)
+                st.caption(f"Answered by the in-memory analytics engine in {trace.total_ms()} ms.")
+            except Exception as e:
+                st.error(st.session_state.config["MESSAGES"]["ERRORS"]["QUERY"])
+                st.error(e)
+        else:
+            # Graph queries returning a named relationship are fetched page by page, the first page as a job
+            paged_query = None
+            if st.session_state.example_key not in TABULAR_QUERIES:
+                paged_query = GraphDB.paged_query(query_input)
+
+            if paged_query is not None:
+                st.session_state.query_pager = Pager(
+                    fetch=partial(
+                        st.session_state.db.query_page,
+                        paged_query,
+                        example_key=st.session_state.example_key,
+                        timeout=st.session_state.config["QUERY"]["TIMEOUT_SECONDS"]
+                        ),
+                    page_size=query_limit
+                    )
+
+            # Run the query in the background so it can be cancelled and bounded in time
+            st.session_state.query_job = st.session_state.db.submit_query(
+                query = query_input if paged_query is None else paged_query,
+                query_limit = query_limit if paged_query is None else None,
+                example_key=st.session_state.example_key,
+                timeout=st.session_state.config["QUERY"]["TIMEOUT_SECONDS"],
+                trace=trace,
+                profile=profile_query,
+                parameters=None if paged_query is None else {"after": None, "page_size": query_limit}
+                )
+    
+    job = st.session_state.query_job
+    if job is not None and not job.done():
+        col1, col2 = st.columns([4, 1])
+        col1.info(f"Running query... {job.elapsed():.1f} seconds, {job.row_count} rows received")
+        
+        # Show the first page of a table while the rest of the result is still arriving
+        if job.example_key in TABULAR_QUERIES and len(job.preview) > 0:
+            st.dataframe(pd.DataFrame(job.preview), hide_index=True)
+        
+        if col2.button("Cancel"):
+            if job.cancel():
+                st.session_state.query_job = None
+                st.session_state.query_pager = None
+                st.warning("The query was cancelled.")
+            elif job.done():
+                # Finished before it could be stopped, the next run shows its result
+                st.rerun()
+            else:
+                st.session_state.query_job = None
+                st.session_state.query_pager = None
+                st.error("The query could not be cancelled, it keeps running on the server until it times out.")
+        else:
+            time.sleep(st.session_state.config["QUERY"]["POLL_INTERVAL_SECONDS"])
+            st.rerun()
+    
+    elif job is not None:
+        st.session_state.query_job = None
+        try:
+            st.session_state.graph_results = job.result()
+            st.session_state.example_key = job.example_key
+            st.session_state.pending_trace = job.trace
+
+            # The first page starts the prefetch of the second one
+            if st.session_state.query_pager is not None:
+                st.session_state.query_pager.add_page(st.session_state.graph_results)
+                st.session_state.graph_results = st.session_state.query_pager.frames()
+            st.session_state.graph_results_key = Visualizer.fingerprint(st.session_state.graph_results)
+            st.caption(f"Query finished in {job.elapsed():.2f} seconds.")
+        except Exception as e:
+            st.session_state.query_pager = None
+            st.error(st.session_state.config["MESSAGES"]["ERRORS"]["QUERY"])
+            st.error(e)
+
+    pager = st.session_state.query_pager
+    if pager is not None and st.session_state.query_job is None and len(pager.pages) > 0:
+        col1, col2 = st.columns([4, 1])
+        col1.caption(
+            f"{pager.row_count()} rows loaded in {len(pager.pages)} pages"
+            f"{'' if pager.complete else ', the next page is prefetched'}."
             )
+        if not pager.complete and col2.button("Load more", key="query_load_more"):
+            trace = RequestTrace("query", example_key=st.session_state.example_key, limit=query_limit, page=len(pager.pages) + 1)
+            try:
+                pager.load_next(trace)
+                st.session_state.pending_trace = trace
+                with trace_stage("query", "pandas"):
+                    st.session_state.graph_results = pager.frames()
+                st.session_state.graph_results_key = Visualizer.fingerprint(st.session_state.graph_results)
+                st.rerun()
+            except Exception as e:
+                st.error(st.session_state.config["MESSAGES"]["ERRORS"]["QUERY"])
+                st.error(e)
     
     if st.session_state.graph_results is None:
         st.info("Please run a query to see the results.")
     else:
         st.header("Results")
         
-        if st.session_state.example_key in [
-            "most_accessible",
-            "population_to_beds",
-            "least_hospitals",
-            "distance_ratio"
-        ]:
-            # Convert graph results to DataFrame
-            data = pd.DataFrame(st.session_state.graph_results)
-            
+        if st.session_state.example_key in TABULAR_QUERIES:
             st.subheader("Table")
-            st.dataframe(data, hide_index=True)
+            st.dataframe(st.session_state.graph_results, hide_index=True)
             
         else:
             subtab1, subtab2 = st.tabs(["Graph", "Table"])
@@ -131,17 +396,27 @@ with tab1:
                     label="Scale node size based on population",
                     value=True
                     )
+                layout_query = config_query.radio(
+                    label="Layout",
+                    options=["force", "geographic"],
+                    format_func=lambda option: option.capitalize(),
+                    horizontal=True,
+                    key="layout_query"
+                    )
                 
                 st.session_state.visualizer.graph_display(
                     data = st.session_state.graph_results, 
                     colors = st.session_state.config["VISUALIZATION"]["COLORS"],
                     height = 600,
                     node_distance = node_distance_query,
-                    population_scaling = scale_pop_query
+                    population_scaling = scale_pop_query,
+                    layout = layout_query,
+                    trace = current_trace("query"),
+                    data_key = st.session_state.graph_results_key
                     )
 
             with subtab2:
-                data = st.session_state.graph_results
+                frames = st.session_state.graph_results
                 
                 category = st.selectbox(
                     label="Select a category to display",
@@ -149,22 +424,20 @@ with tab1:
                     )
                 
                 if category == "Hospitals":
-                    filtered_data = [record["hospital"] for record in data if record["hospital"] is not None]
+                    filtered_data = frames["Hospital"]
                     if len(filtered_data) > 0:
-                        filtered_data = pd.DataFrame(filtered_data).rename(
+                        filtered_data = filtered_data.rename(
                             columns=st.session_state.config["VISUALIZATION"]["COLUMN_NAMING"]["HOSPITALS"]
                             ).set_index(st.session_state.config["VISUALIZATION"]["COLUMN_NAMING"]["HOSPITALS"]["hospital_name"])
 
                 elif category == "SA2s":
-                    filtered_data = [record["sa2"] for record in data if record["sa2"] is not None]
+                    filtered_data = frames["SA2"]
                     if len(filtered_data) > 0:
-                        filtered_data = pd.DataFrame(filtered_data).rename(
+                        filtered_data = filtered_data.rename(
                             columns=st.session_state.config["VISUALIZATION"]["COLUMN_NAMING"]["SA2"]
                             ).set_index(st.session_state.config["VISUALIZATION"]["COLUMN_NAMING"]["SA2"]["sa2_name"])
                 elif category == "Distances":
-                    hospitals = [record["hospital"] for record in data if record["hospital"] is not None]
-                    sa2 = [record["sa2"] for record in data if record["sa2"] is not None]
-                    if len(hospitals) and len(sa2) > 0:
+                    if len(frames["edges"]) > 0:
                         method = st.radio(
                             label="Select a filtering method",
                             options=[
@@ -174,74 +447,68 @@ with tab1:
                                 ]
                         )
                         
-                        filtered_data = [{
-                            "hospital_name": record["hospital"]["hospital_name"] if record["hospital"] is not None else None,
-                            "sa2": record["sa2"]["sa2_name"] if record["sa2"] is not None else None,
-                            "distance (seconds)": record["relation"]["distance_time"] if record["relation"] is not None else None,
-                            "accessible": record["relation"]["accessible"] if record["relation"] is not None else None,
-                            "further_than_2_hours": record["relation"]["further_than_2h"] if record["relation"] is not None else None,
-                            
-                            } for record in data]
-                        filtered_data = pd.DataFrame(filtered_data)
-                        
                         if method == "Group by Hospital":
-                            filtered_data = filtered_data.groupby("hospital_name").agg(
-                                {
-                                    "sa2": "count",
-                                    "distance (seconds)": ["mean", "min", "max"],
-                                    "accessible": "mean",
-                                    "further_than_2_hours": "mean"
-                                    }
-                                )
-                            # Multiply by 100 to get percentage
-                            filtered_data["accessible"] = round(filtered_data["accessible"] * 100, 2)
-                            filtered_data["further_than_2_hours"] = round(filtered_data["further_than_2_hours"] * 100)
+                            # The statistics are computed by the database over the full graph
+                            st.caption("Statistics over all hospitals in the graph, not limited to the query result.")
+                            filtered_data = st.session_state.db.distance_stats_by_hospital()
+                            if len(filtered_data) > 0:
+                                filtered_data = filtered_data.drop(columns="hospital_id").set_index("hospital_name").round(2)
                             
-                            # Rename index
-                            filtered_data.index.name = "Hospital Name"
+                                # Rename index
+                                filtered_data.index.name = "Hospital Name"
                             
-                            # Rename columns
-                            filtered_data.columns = [
-                                "Number of SA2s",
-                                "Mean Distance (seconds)",
-                                "Min Distance (seconds)",
-                                "Max Distance (seconds)",
-                                "Mean Accessible (%)",
-                                "Mean Further than 2 hours (%)"
-                                ]
+                                # Rename columns
+                                filtered_data.columns = [
+                                    "Number of SA2s",
+                                    "Mean Distance (seconds)",
+                                    "Min Distance (seconds)",
+                                    "Max Distance (seconds)",
+                                    "Mean Accessible (%)",
+                                    "Mean Further than 2 hours (%)"
+                                    ]
                             
                         elif method == "Group by SA2":
-                            filtered_data = filtered_data.groupby("sa2").agg(
-                                {
-                                    "hospital_name": "count",
-                                    "distance (seconds)": ["mean", "min", "max"],
-                                    "accessible": "mean",
-                                    "further_than_2_hours": "mean"
-                                    }
-                                )
-                            
-                            # Multiply by 100 to get percentage
-                            filtered_data["accessible"] = round(filtered_data["accessible"] * 100, 2)
-                            filtered_data["further_than_2_hours"] = round(filtered_data["further_than_2_hours"] * 100, 2) 
+                            # The statistics are computed by the database over the full graph
+                            st.caption("Statistics over all SA2 regions in the graph, not limited to the query result.")
+                            filtered_data = st.session_state.db.distance_stats_by_sa2()
+                            if len(filtered_data) > 0:
+                                filtered_data = filtered_data.drop(columns="sa2_id").set_index("sa2_name").round(2)
 
-                            # Rename index
-                            filtered_data.index.name = "SA2 Name"
+                                # Rename index
+                                filtered_data.index.name = "SA2 Name"
                         
-                            # Rename columns
-                            filtered_data.columns = [
-                                "Number of Hospitals",
-                                "Mean Distance (seconds)",
-                                "Min Distance (seconds)",
-                                "Max Distance (seconds)",
-                                "Mean Accessible (%)",
-                                "Mean Further than 2 hours (%)"
-                                ]
+                                # Rename columns
+                                filtered_data.columns = [
+                                    "Number of Hospitals",
+                                    "Mean Distance (seconds)",
+                                    "Min Distance (seconds)",
+                                    "Max Distance (seconds)",
+                                    "Mean Accessible (%)",
+                                    "Mean Further than 2 hours (%)"
+                                    ]
                             
                         else:
+                            # Add the hospital and SA2 names to the edges
+                            filtered_data = frames["edges"].merge(
+                                frames["Hospital"][["id", "hospital_name"]].rename(columns={"id": "hospital_id"}),
+                                on="hospital_id",
+                                how="left"
+                                ).merge(
+                                frames["SA2"][["id", "sa2_name"]].rename(columns={"id": "sa2_id"}),
+                                on="sa2_id",
+                                how="left"
+                                )
+                            filtered_data = filtered_data[[
+                                "hospital_name",
+                                "sa2_name",
+                                "distance_time",
+                                "accessible",
+                                "further_than_2h"
+                                ]]
                             filtered_data.columns = [
                                 "Hospital Name",
                                 "SA2 Name",
-                                "Mean Distance (seconds)",
+                                "Distance (seconds)",
                                 "Accessible",
                                 "Further than 2 hours"
                                 ]
@@ -252,8 +519,6 @@ with tab1:
                 
                 
                 if len(filtered_data) > 0:
-                    # Drop duplicates
-                    filtered_data = filtered_data.drop_duplicates()
                     st.dataframe(filtered_data)
                 else:
                     st.info("No data to display")
@@ -262,19 +527,49 @@ with tab1:
         st.header("Explore Knowledge Graph")
         config_exp = st.expander("Graph Settings", expanded=True)
         with config_exp:
+            level_of_detail = st.checkbox(
+                label="Cluster SA2 regions for large graphs (level of detail)",
+                value=True,
+                help="Above the node threshold SA2 regions are grouped into super-nodes, click a super-node to expand it."
+                )
             graph_limit = st.slider(
-                label="Limit the number of relationships to display", 
+                label="Number of hospitals per page, each with all its relationships", 
                 min_value=0, 
-                max_value=1000, 
-                value=100
+                max_value=st.session_state.config["VISUALIZATION"]["LEVEL_OF_DETAIL"]["MAX_HOSPITALS"] if level_of_detail else 100, 
+                value=10
                 )
         
-        if st.button("Load Graph"):
-            st.session_state.graph_database = st.session_state.db.fetch_data(
-                    limit = graph_limit
-                    )
-            st.session_state.graph_size = graph_limit
-            
+        # The graph is loaded in pages of the chosen number of hospitals ordered by id,
+        # every page continues after the last hospital of the previous one
+        col1, col2 = st.columns([1, 4])
+        load_graph = col1.button("Load Graph", disabled=not connected)
+        graph_pager = st.session_state.graph_pager
+        load_more = (
+            graph_pager is not None and not graph_pager.complete
+            and col2.button("Load more", key="graph_load_more")
+            )
+
+        if load_graph or load_more:
+            if load_graph:
+                st.session_state.graph_pager = Pager(fetch=st.session_state.db.fetch_page, page_size=graph_limit)
+            graph_pager = st.session_state.graph_pager
+            st.session_state.pending_trace = RequestTrace("full graph", limit=graph_limit, page=len(graph_pager.pages) + 1)
+            try:
+                graph_pager.load_next(trace=current_trace("full graph"))
+                st.session_state.graph_database = graph_pager.frames()
+                st.session_state.graph_database_key = Visualizer.fingerprint(st.session_state.graph_database)
+                st.rerun()
+            except Exception as e:
+                st.error(st.session_state.config["MESSAGES"]["ERRORS"]["QUERY"])
+                st.error(e)
+
+        if graph_pager is not None and len(graph_pager.pages) > 0:
+            st.caption(
+                f"{len(st.session_state.graph_database['edges'])} relationships of "
+                f"{len(st.session_state.graph_database['Hospital'])} hospitals loaded in {len(graph_pager.pages)} pages"
+                f"{'' if graph_pager.complete else ', the next page is prefetched'}."
+                )
+
         if st.session_state.graph_database is not None:
             st.subheader("Graph")
             st.write(f"""
@@ -299,14 +594,139 @@ with tab1:
                 label="Scale node size based on population",
                 value=False
                 )
+            layout_graph = config_graph.radio(
+                label="Layout",
+                options=["force", "geographic"],
+                format_func=lambda option: option.capitalize(),
+                horizontal=True,
+                key="layout_graph"
+                )
+            cluster_by = config_graph.radio(
+                label="Group SA2 regions by",
+                options=["nearest", "state"],
+                format_func=lambda option: "Closest hospital" if option == "nearest" else "State of the closest hospital",
+                horizontal=True,
+                disabled=not level_of_detail
+                )
                 
             st.session_state.visualizer.graph_display(
                 st.session_state.graph_database, 
                 colors = st.session_state.config["VISUALIZATION"]["COLORS"],
                 height = 600,
                 node_distance = node_distance_graph,
-                population_scaling = scale_pop_graph
+                population_scaling = scale_pop_graph,
+                level_of_detail = level_of_detail,
+                cluster_by = cluster_by,
+                detail_threshold = st.session_state.config["VISUALIZATION"]["LEVEL_OF_DETAIL"]["NODE_THRESHOLD"],
+                layout = layout_graph,
+                trace = current_trace("full graph"),
+                data_key = st.session_state.graph_database_key
                 )
 
+with tab3:
+    st.header("What-if Scenarios")
+    st.write(f"""
+            Open a hospital at a coordinate or close an existing one to see which SA2 regions get different closest hospitals.
+            Travel times to new hospitals are estimated from the distance, the changes are kept until you reset them.
+            """)
+
+    if st.session_state.scenario is None:
+        if st.button("Start Scenario", disabled=not connected):
+            try:
+                from lib.ScenarioEngine import ScenarioEngine
+
+                # Every session gets its own scenario on top of the shared analytics engine
+                analytics = st.session_state.config["ANALYTICS"]
+                engine = get_analytics_engine(analytics["SOURCE"], analytics["DATADIR"], st.session_state.db)
+                st.session_state.scenario = ScenarioEngine(engine)
+                st.rerun()
+            except Exception as e:
+                st.error(st.session_state.config["MESSAGES"]["ERRORS"]["QUERY"])
+                st.error(e)
+    else:
+        scenario = st.session_state.scenario
+        col1, col2 = st.columns(2)
+
+        with col1:
+            st.subheader("Open Hospital")
+            new_name = st.text_input("Name", "New hospital")
+            new_latitude = st.number_input("Latitude", min_value=-90.0, max_value=90.0, value=-23.7, format="%.4f")
+            new_longitude = st.number_input("Longitude", min_value=-180.0, max_value=180.0, value=133.88, format="%.4f")
+            if st.button("Open Hospital"):
+                st.session_state.scenario_report = scenario.open_hospital(new_latitude, new_longitude, new_name)
 
+        with col2:
+            st.subheader("Close Hospital")
+            open_hospitals = np.flatnonzero(scenario.hospital_open)
+            closed_position = st.selectbox(
+                label="Hospital",
+                options=open_hospitals,
+                format_func=lambda position: scenario.hospital_names[position]
+                )
+            if st.button("Close Hospital") and closed_position is not None:
+                st.session_state.scenario_report = scenario.close_hospital(scenario.hospital_ids[closed_position])
+            if st.button("Reset Scenario"):
+                scenario.reset()
+                st.session_state.scenario_report = None
+
+        summary = scenario.summary()
+        col1, col2 = st.columns(2)
+        col1.metric(
+            "SA2s without an accessible hospital",
+            summary["sa2_without_accessible"],
+            summary["sa2_without_accessible"] - summary["base_sa2_without_accessible"],
+            delta_color="inverse"
+            )
+        col2.metric(
+            "Population without an accessible hospital",
+            f"{summary['population_without_accessible']:,.0f}",
+            f"{summary['population_without_accessible'] - summary['base_population_without_accessible']:,.0f}",
+            delta_color="inverse"
+            )
+
+        if len(scenario.changes) > 0:
+            st.subheader("Changes")
+            st.dataframe(pd.DataFrame(scenario.changes).rename(columns={
+                "change": "Change",
+                "affected_sa2": "Affected SA2s",
+                "milliseconds": "Time (ms)"
+                }), hide_index=True)
+
+        if st.session_state.scenario_report is not None:
+            st.subheader("Affected SA2 Regions")
+            if len(st.session_state.scenario_report) > 0:
+                st.dataframe(st.session_state.scenario_report.round(2), hide_index=True)
+            else:
+                st.info("No SA2 region has different closest hospitals.")
+
+# Log the request that finished in this run, then keep it for the Performance panel
+if st.session_state.pending_trace is not None:
+    st.session_state.pending_trace.write(st.session_state.config["PERFORMANCE"]["LOG_PATH"])
+    st.session_state.last_trace = st.session_state.pending_trace
+    st.session_state.pending_trace = None
+
+with st.expander("Performance", expanded=False):
+    trace = st.session_state.last_trace
+    if trace is None:
+        st.info("Run a query or load the graph to see where the time is spent.")
+    else:
+        trace_data = trace.to_dict()
+        st.write(f"Last request: **{trace_data['name']}**, {trace_data['total_ms']} ms in total")
+        st.dataframe(pd.DataFrame(trace_data["stages"]), hide_index=True)
+        
+        for query_summary in trace_data["queries"]:
+            st.code(query_summary["query"])
+            col1, col2, col3 = st.columns(3)
+            col1.metric("Available after (ms)", query_summary["result_available_after_ms"])
+            col2.metric("Consumed after (ms)", query_summary["result_consumed_after_ms"])
+            col3.metric("DB hits", query_summary.get("db_hits", "-"))
+            if len(query_summary["counters"]) > 0:
+                st.json(query_summary["counters"])
+            if "plan" in query_summary:
+                st.dataframe(pd.DataFrame(query_summary["plan"]), hide_index=True)
+        st.caption(f"Requests are logged to {st.session_state.config['PERFORMANCE']['LOG_PATH']}")
 
+# Draw the page again once the connection is made
+if not connected:
+    time.sleep(st.session_state.config["QUERY"]["POLL_INTERVAL_SECONDS"])
+    st.rerun()
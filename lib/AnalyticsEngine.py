@@ -0,0 +1,204 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from lib.GraphDB import GraphDB
+from lib import Pipeline
+
+class AnalyticsEngine:
+    # Answers the fixed example queries from the Hospital -> SA2 edges held in memory as CSR arrays,
+    # the edges of every SA2 are contiguous and sorted by travel time. Ad-hoc Cypher still goes to Neo4j
+    ANSWERS = {
+        "not_accessible": "not_accessible",
+        "not_accessible_fast": "not_accessible",
+        "most_accessible": "most_accessible",
+        "population_to_beds": "population_to_beds",
+        "population_to_beds_fast": "population_to_beds_fast",
+        "least_hospitals": "least_hospitals",
+        "least_hospitals_fast": "least_hospitals_fast",
+        "distance_ratio": "distance_ratio",
+        "distance_ratio_fast": "distance_ratio"
+        }
+
+    def __init__(self, sa2: list, hospitals: list, edges: pd.DataFrame):
+        # sa2 and hospitals are lists of node property dictionaries, edges has the positions of
+        # its SA2 and hospital in those lists and the distance_time, accessible and further_than_2h columns
+        self.sa2 = sa2
+        self.hospitals = hospitals
+
+        self.sa2_names = np.array([node.get("sa2_name") for node in sa2], dtype=object)
+        self.sa2_population = np.array([self._number(node.get("population")) for node in sa2], dtype=np.float64)
+        self.hospital_states = np.array([node.get("state") for node in hospitals], dtype=object)
+        self.hospital_beds = np.array([self.beds_value(node.get("beds")) for node in hospitals], dtype=np.float64)
+        self.hospital_beds_max = np.array([self.beds_upper_bound(node.get("beds")) for node in hospitals], dtype=np.float64)
+
+        # CSR by SA2, the edges of a SA2 sorted by travel time
+        sa2_positions = edges["sa2"].to_numpy(dtype=np.int64)
+        distances = edges["distance_time"].to_numpy(dtype=np.float64)
+        order = np.lexsort((distances, sa2_positions))
+        self.indptr = np.concatenate([[0], np.cumsum(np.bincount(sa2_positions, minlength=len(sa2)))]).astype(np.int64)
+        self.edge_sa2 = sa2_positions[order]
+        self.edge_hospital = edges["hospital"].to_numpy(dtype=np.int32)[order]
+        self.edge_distance = distances[order]
+        self.edge_accessible = edges["accessible"].to_numpy(dtype=bool)[order]
+
+    ### LOADING
+    @classmethod
+    def from_processed(cls, datadir: str = "data/processed") -> "AnalyticsEngine":
+        # Build the engine from the processed csv files, the node properties are those written by GraphDB
+        sa2 = pd.read_csv(os.path.join(datadir, "SA2PopulationData.csv"))
+        hospitals = pd.read_csv(os.path.join(datadir, "HospitalMetadata.csv"))
+        accessibility_path = os.path.join(datadir, "AccessibilityEdges.csv")
+        edges = Pipeline.edge_list(
+            pd.read_csv(os.path.join(datadir, "HospitalDistance.csv")),
+            pd.read_csv(accessibility_path) if os.path.exists(accessibility_path) else None
+            )
+
+        sa2_nodes = list(GraphDB.sa2_rows(sa2))
+        hospital_nodes = list(GraphDB.hospital_rows(hospitals))
+        edge_rows = pd.DataFrame(list(GraphDB.edge_rows(edges)))
+
+        # Like the MATCH in GraphDB.bulk_load_edges, an edge is added to every node with its id
+        sa2_keys = pd.DataFrame({"sa2_5dig": [node["id"] for node in sa2_nodes], "sa2": np.arange(len(sa2_nodes))})
+        hospital_keys = pd.DataFrame({"hospital_id": [node["id"] for node in hospital_nodes], "hospital": np.arange(len(hospital_nodes))})
+        edge_rows = edge_rows.merge(sa2_keys, on="sa2_5dig").merge(hospital_keys, on="hospital_id")
+        return cls(sa2_nodes, hospital_nodes, edge_rows)
+
+    @classmethod
+    def from_graph(cls, graph_db: GraphDB) -> "AnalyticsEngine":
+        # Read the nodes and edges from Neo4j once
+        with graph_db.driver.session(database=graph_db.database) as session:
+            sa2_keys, sa2_nodes = {}, []
+            for record in session.run("MATCH (s:SA2) RETURN elementId(s) AS key, s"):
+                sa2_keys[record["key"]] = len(sa2_nodes)
+                sa2_nodes.append(dict(record["s"]))
+
+            hospital_keys, hospital_nodes = {}, []
+            for record in session.run("MATCH (h:Hospital) RETURN elementId(h) AS key, h"):
+                hospital_keys[record["key"]] = len(hospital_nodes)
+                hospital_nodes.append(dict(record["h"]))
+
+            edges = {"sa2": [], "hospital": [], "distance_time": [], "accessible": [], "further_than_2h": []}
+            for record in session.run(
+                "MATCH (h:Hospital)-[r:REACHABLE_VIA]->(s:SA2) "
+                "RETURN elementId(h) AS hospital, elementId(s) AS sa2, "
+                "r.distance_time AS distance_time, r.accessible AS accessible, r.further_than_2h AS further_than_2h"
+                ):
+                edges["sa2"].append(sa2_keys[record["sa2"]])
+                edges["hospital"].append(hospital_keys[record["hospital"]])
+                edges["distance_time"].append(record["distance_time"])
+                edges["accessible"].append(bool(record["accessible"]))
+                edges["further_than_2h"].append(bool(record["further_than_2h"]))
+        return cls(sa2_nodes, hospital_nodes, pd.DataFrame(edges))
+
+    @staticmethod
+    def _number(value) -> float:
+        return np.nan if value is None else float(value)
+
+    @staticmethod
+    def beds_value(beds) -> float:
+        # The beds as read by the population_to_beds query, only "<50" and ">500" give a number
+        if not isinstance(beds, str):
+            return np.nan
+        value = beds.replace("<", "").replace(">", "")
+        return float(value) if value.isdigit() else np.nan
+
+    @staticmethod
+    def beds_upper_bound(beds) -> float:
+        # The upper bound of the beds category, as stored by GraphDB.refresh_hospital_beds
+        if not isinstance(beds, str):
+            return np.nan
+        value = beds.lstrip("<>").split("-")[-1]
+        return float(value) if value.isdigit() else np.nan
+
+    ### QUERIES
+    def supports(self, example_key: str) -> bool:
+        return example_key in self.ANSWERS
+
+    def run_query(self, example_key: str, query_limit: int | None = None) -> list:
+        # Rows in the same shape as GraphDB.run_query returns for the example query
+        rows = getattr(self, self.ANSWERS[example_key])()
+        return rows if query_limit is None else rows[:query_limit]
+
+    def counts(self) -> tuple:
+        # Number of edges, distinct hospitals and accessible distinct hospitals per SA2
+        edges = np.diff(self.indptr)
+        pairs = np.unique(self.edge_sa2 * len(self.hospitals) + self.edge_hospital)
+        hospitals = np.bincount(pairs // max(1, len(self.hospitals)), minlength=len(self.sa2))
+        accessible_pairs = np.unique((self.edge_sa2 * len(self.hospitals) + self.edge_hospital)[self.edge_accessible])
+        accessible = np.bincount(accessible_pairs // max(1, len(self.hospitals)), minlength=len(self.sa2))
+        return edges, hospitals, accessible
+
+    def not_accessible(self) -> list:
+        _, _, accessible = self.counts()
+        return [{"hospital": None, "sa2": self.sa2[position], "relation": None} for position in np.flatnonzero(accessible == 0)]
+
+    def most_accessible(self) -> list:
+        hospitals = np.unique(self.edge_hospital[self.edge_accessible])
+        states, counts = np.unique(self.hospital_states[hospitals].astype(str), return_counts=True)
+        order = np.argsort(-counts, kind="stable")
+        return [{"State": str(states[i]), "AccessibleHospitals": int(counts[i])} for i in order]
+
+    def least_hospitals(self) -> list:
+        # Grouped by name like the Cypher query, SA2s sharing a name are counted together
+        names, name_codes = np.unique(self.sa2_names.astype(str), return_inverse=True)
+        pairs = np.unique(name_codes[self.edge_sa2] * len(self.hospitals) + self.edge_hospital)
+        counts = np.bincount(pairs // max(1, len(self.hospitals)), minlength=len(names))
+        present = np.flatnonzero(counts > 0)
+        order = present[np.argsort(counts[present], kind="stable")]
+        return [{"SA2Area": str(names[i]), "HospitalCount": int(counts[i])} for i in order]
+
+    def least_hospitals_fast(self) -> list:
+        _, hospitals, _ = self.counts()
+        present = np.flatnonzero(hospitals > 0)
+        order = present[np.argsort(hospitals[present], kind="stable")]
+        return [{"SA2Area": self.sa2_names[i], "HospitalCount": int(hospitals[i])} for i in order]
+
+    def distance_ratio(self) -> list:
+        # The edges are sorted by travel time, so the first and last edge of every SA2 are the closest and furthest
+        present = np.flatnonzero(np.diff(self.indptr) > 0)
+        closest = self.edge_distance[self.indptr[present]]
+        furthest = self.edge_distance[self.indptr[present + 1] - 1]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            ratio = np.where(closest == 0, np.nan, furthest / closest)
+
+        # Descending, with the undefined ratios last as Cypher orders strings after numbers
+        order = np.lexsort((-np.nan_to_num(ratio, nan=0.0), np.isnan(ratio)))
+        return [{
+            "SA2Area": self.sa2_names[present[i]],
+            "ClosestHospitalDistance": float(closest[i]),
+            "FurthestHospitalDistance": float(furthest[i]),
+            "DistanceRatio": "Undefined" if np.isnan(ratio[i]) else float(ratio[i])
+            } for i in order]
+
+    def population_to_beds(self) -> list:
+        # Grouped by name and population like the Cypher query, unparsable bed categories are skipped
+        frame = pd.DataFrame({
+            "SA2Area": self.sa2_names[self.edge_sa2],
+            "Population": self.sa2_population[self.edge_sa2],
+            "Beds": self.hospital_beds[self.edge_hospital]
+            })
+        totals = frame.groupby(["SA2Area", "Population"], sort=False, dropna=False)["Beds"].sum(min_count=0)
+        return [{
+            "SA2Area": name,
+            "Population": None if np.isnan(population) else float(population),
+            "TotalBeds": int(total),
+            "Ratio": None if total == 0 or np.isnan(population) else float(population / total)
+            } for (name, population), total in totals.items()]
+
+    def population_to_beds_fast(self) -> list:
+        # Bed ranges count with their upper bound, like the precomputed total_beds
+        present = np.flatnonzero(np.diff(self.indptr) > 0)
+        beds = np.nan_to_num(self.hospital_beds_max[self.edge_hospital])
+        totals = np.add.reduceat(beds, self.indptr[present]) if len(present) > 0 else np.empty(0)
+        rows = []
+        for position, total in zip(present, totals):
+            population = None if np.isnan(self.sa2_population[position]) else float(self.sa2_population[position])
+            rows.append({
+                "SA2Area": self.sa2_names[position],
+                "Population": population,
+                "TotalBeds": int(total),
+                "Ratio": None if total == 0 or population is None else population / float(total)
+                })
+        return rows
@@ -0,0 +1,311 @@
+import argparse
+from datetime import datetime, timezone
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+import pandas as pd
+import yaml
+from yaml.loader import SafeLoader
+
+from lib.AnalyticsEngine import AnalyticsEngine
+from lib.GraphDB import GraphDB
+from lib.ParallelLoader import ParallelLoader
+from lib.Visualizer import Visualizer
+from lib import Pipeline
+
+# Metrics slower than the baseline by more than this fraction are reported as regressions
+DEFAULT_TOLERANCE = 0.2
+
+# What the dashboard imports before it draws the page, and the modules it loads later on
+IMPORTS = {
+    "interpreter": "pass",
+    "dashboard_shell": "import streamlit, yaml; import lib.QueryCache, lib.RequestTrace",
+    "graph_db": "import lib.GraphDB",
+    "visualizer": "import lib.Visualizer",
+    "analytics_engine": "import lib.AnalyticsEngine",
+    "scenario_engine": "import lib.ScenarioEngine"
+    }
+
+def load_data(datadir: str) -> dict:
+    # The processed csv files the graph is built from, with one row per edge
+    return {
+        "sa2": pd.read_csv(os.path.join(datadir, "SA2PopulationData.csv")),
+        "hospitals": pd.read_csv(os.path.join(datadir, "HospitalMetadata.csv")),
+        "edges": Pipeline.edge_list(pd.read_csv(os.path.join(datadir, "HospitalDistance.csv")))
+        }
+
+def scale_data(data: dict, factor: int) -> dict:
+    # Copy the SA2s, hospitals and edges factor times with suffixed ids, each copy is a separate graph
+    sa2_copies, hospital_copies, edge_copies = [], [], []
+    for copy in range(factor):
+        sa2 = data["sa2"].copy()
+        hospitals = data["hospitals"].copy()
+        edges = data["edges"].copy()
+        if copy > 0:
+            sa2["SA2_5DIG"] = sa2["SA2_5DIG"].astype(str) + f"_{copy}"
+            hospitals["hospital_ID"] = hospitals["hospital_ID"].astype(str) + f"_{copy}"
+            edges["SA2_5DIG"] = edges["SA2_5DIG"].astype(str) + f"_{copy}"
+            edges["hospital_ID"] = edges["hospital_ID"].astype(str) + f"_{copy}"
+
+            # Names identify the nodes in the graph view, so the copies get their own
+            sa2["SA2_name"] = sa2["SA2_name"] + f" ({copy})"
+            hospitals["hospital_name"] = hospitals["hospital_name"] + f" ({copy})"
+
+        sa2_copies.append(sa2)
+        hospital_copies.append(hospitals)
+        edge_copies.append(edges)
+
+    return {
+        "sa2": pd.concat(sa2_copies, ignore_index=True),
+        "hospitals": pd.concat(hospital_copies, ignore_index=True),
+        "edges": pd.concat(edge_copies, ignore_index=True)
+        }
+
+def graph_rows(data: dict, limit: int) -> list:
+    # Rows in the shape returned by GraphDB.fetch_data, built from the csv files so rendering
+    # can be measured without a database
+    sa2s = {row["id"]: row for row in GraphDB.sa2_rows(data["sa2"])}
+    hospitals = {row["id"]: row for row in GraphDB.hospital_rows(data["hospitals"])}
+    rows = []
+    for edge in GraphDB.edge_rows(data["edges"].head(limit)):
+        rows.append({
+            "hospital": hospitals.get(edge["hospital_id"]),
+            "sa2": sa2s.get(edge["sa2_5dig"]),
+            "relation": {
+                "distance_time": edge["distance_time"],
+                "accessible": edge["accessible"],
+                "further_than_2h": edge["further_than_2h"]
+                }
+            })
+    return rows
+
+def measure(function, repeat: int) -> dict:
+    # Wall time of repeated runs, the median is what gets compared to the baseline. A first untimed run
+    # warms up the imports, plan cache and page cache so they are not counted in the first measurement
+    function()
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return {
+        "median_seconds": statistics.median(timings),
+        "min_seconds": min(timings),
+        "runs": repeat
+        }
+
+def benchmark_imports(repeat: int) -> dict:
+    # Cold import times, every run starts a new interpreter so nothing is imported yet.
+    # The interpreter entry is the start up time included in the others
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    return {
+        name: measure(lambda: subprocess.run([sys.executable, "-c", statement], cwd=root, check=True), repeat)
+        for name, statement in IMPORTS.items()
+        }
+
+def benchmark_ingest(graph_db: GraphDB, data: dict, workers: int = 1) -> dict:
+    # Load a scaled copy of the data into an empty database, the loaders report their own throughput.
+    # With more than one worker the edges are written by the ParallelLoader
+    graph_db.clear()
+    results = {}
+    edge_loader = graph_db.bulk_load_edges if workers <= 1 else ParallelLoader(graph_db, workers).load_edges
+    for name, loader, frame in [
+        ("sa2", graph_db.bulk_load_sa2, data["sa2"]),
+        ("hospitals", graph_db.bulk_load_hospitals, data["hospitals"]),
+        ("edges", edge_loader, data["edges"])
+        ]:
+        start = time.perf_counter()
+        report = loader(frame)
+        results[name] = {
+            "median_seconds": time.perf_counter() - start,
+            "rows": report["rows"],
+            "rows_per_second": report["rows_per_second"]
+            }
+    return results
+
+def benchmark_queries(graph_db: GraphDB, example_queries: dict, query_limit: int, repeat: int) -> dict:
+    # Every example query of the dashboard, run with the limit the dashboard would add
+    results = {}
+    for example_query in example_queries.values():
+        rows = []
+        def run():
+            rows[:] = graph_db.run_query(example_query["query"], query_limit, example_query["key"])
+        results[example_query["key"]] = {**measure(run, repeat), "rows": len(rows)}
+    return results
+
+def benchmark_fetch(graph_db: GraphDB, limits: list, repeat: int) -> dict:
+    results = {}
+    for limit in limits:
+        rows = []
+        def run():
+            rows[:] = graph_db.fetch_data(limit)
+        results[str(limit)] = {**measure(run, repeat), "rows": len(rows)}
+    return results
+
+def benchmark_analytics(datadir: str, example_queries: dict, query_limit: int, repeat: int) -> dict:
+    # The example queries answered by the in-memory engine, loaded from the csv files
+    engine = []
+    results = {"load": measure(lambda: engine.append(AnalyticsEngine.from_processed(datadir)), 1)}
+    for example_query in example_queries.values():
+        if engine[0].supports(example_query["key"]):
+            results[example_query["key"]] = measure(lambda: engine[0].run_query(example_query["key"], query_limit), repeat)
+    return results
+
+def benchmark_render(data: dict, colors: dict, limits: list, repeat: int) -> dict:
+    # The HTML generation of graph_display without its caches and the Streamlit component,
+    # for the force layout and the level of detail view
+    visualizer = Visualizer()
+    results = {}
+    for limit in limits:
+        frames = GraphDB.to_frames(graph_rows(data, limit))
+        graph = visualizer.build_graph(frames, colors)
+        results[str(limit)] = {
+            "build_graph": measure(lambda: visualizer.build_graph(frames, colors), repeat),
+            "render_html": measure(lambda: visualizer.render_html(graph, 600, 500, True), repeat),
+            "render_clustered_html": measure(lambda: visualizer.render_clustered_html(graph, colors, 600, "nearest"), repeat),
+            "nodes": len(graph["nodes"]),
+            "edges": len(graph["edges"])
+            }
+    return results
+
+def run(
+    config: dict, datadir: str, scales: list, limits: list, repeat: int, query_limit: int, ingest: bool,
+    workers: int = 1
+    ) -> dict:
+    data = load_data(datadir)
+    results = {
+        "started_at": datetime.now(timezone.utc).isoformat(),
+        "environment": {
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "pandas": pd.__version__
+            },
+        "settings": {
+            "scales": scales,
+            "limits": limits,
+            "repeat": repeat,
+            "query_limit": query_limit,
+            "ingest": ingest,
+            "workers": workers
+            },
+        "imports": benchmark_imports(repeat),
+        "render": benchmark_render(data, config["VISUALIZATION"]["COLORS"], limits, repeat),
+        "analytics": benchmark_analytics(datadir, config["EXAMPLE_QUERIES"], query_limit, repeat)
+        }
+
+    try:
+        graph_db = GraphDB(
+            uri=config["DATABASE"]["URI"],
+            user=config["DATABASE"]["USER"],
+            password=config["DATABASE"]["PASSWORD"],
+            database=config["DATABASE"]["DBNAME"]
+            )
+    except Exception as e:
+        # Rendering is still measured, the database stages are marked as skipped
+        results["skipped"] = f"Neo4j is not reachable: {e}"
+        return results
+
+    try:
+        graph_db.ensure_schema()
+        for error in graph_db.schema_errors:
+            print(f"Schema not created: {error}")
+        if ingest:
+            results["ingest"], results["queries"], results["fetch_data"] = {}, {}, {}
+            for factor in scales:
+                scale = f"{factor}x"
+                results["ingest"][scale] = benchmark_ingest(graph_db, scale_data(data, factor), workers)
+                results["queries"][scale] = benchmark_queries(graph_db, config["EXAMPLE_QUERIES"], query_limit, repeat)
+                results["fetch_data"][scale] = benchmark_fetch(graph_db, limits, repeat)
+
+            # Leave the database with the original data
+            if scales[-1] != 1:
+                benchmark_ingest(graph_db, data, workers)
+        else:
+            # Measure against the data that is already loaded
+            results["queries"] = {"current": benchmark_queries(graph_db, config["EXAMPLE_QUERIES"], query_limit, repeat)}
+            results["fetch_data"] = {"current": benchmark_fetch(graph_db, limits, repeat)}
+    finally:
+        graph_db.close()
+    return results
+
+def flatten(results: dict, prefix: str = "") -> dict:
+    # The median timings keyed by their path, e.g. "queries/1x/most_accessible"
+    metrics = {}
+    for key, value in results.items():
+        if not isinstance(value, dict):
+            continue
+        path = f"{prefix}/{key}" if prefix else key
+        if "median_seconds" in value:
+            metrics[path] = value["median_seconds"]
+        else:
+            metrics.update(flatten(value, path))
+    return metrics
+
+def compare(results: dict, baseline: dict, tolerance: float = DEFAULT_TOLERANCE) -> list:
+    # Every metric present in both runs with its change, regressions are slower than the tolerance allows
+    current, previous = flatten(results), flatten(baseline)
+    comparison = []
+    for path in sorted(current.keys() & previous.keys()):
+        ratio = current[path] / previous[path] if previous[path] > 0 else 1.0
+        comparison.append({
+            "metric": path,
+            "baseline_seconds": previous[path],
+            "seconds": current[path],
+            "ratio": ratio,
+            "regression": ratio > 1 + tolerance
+            })
+    return comparison
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark loading, querying and rendering the knowledge graph")
+    parser.add_argument("--config", default="config.yaml", help="Configuration file with the database settings and example queries")
+    parser.add_argument("--datadir", default="data/processed", help="Directory with the processed csv files")
+    parser.add_argument("--scales", type=int, nargs="+", default=[1, 10, 100], help="Number of copies of the data to load")
+    parser.add_argument("--limits", type=int, nargs="+", default=[100, 1000, 10000], help="Relationship limits for fetch_data and rendering")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per measurement, the median is reported")
+    parser.add_argument("--query-limit", type=int, default=1000, help="LIMIT added to the example queries")
+    parser.add_argument("--ingest", action="store_true", help="Measure the loaders, this CLEARS the database and reloads it at every scale")
+    parser.add_argument("--workers", type=int, default=1, help="Parallel sessions loading the edges with --ingest")
+    parser.add_argument("--output", default="benchmarks/latest.json", help="File to write the results to")
+    parser.add_argument("--baseline", default="benchmarks/baseline.json", help="Results to compare against")
+    parser.add_argument("--save-baseline", action="store_true", help="Store the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE, help="Allowed slowdown before a metric counts as a regression")
+    args = parser.parse_args()
+
+    with open(args.config) as config_file:
+        config = yaml.load(config_file, Loader=SafeLoader)
+
+    results = run(config, args.datadir, args.scales, args.limits, args.repeat, args.query_limit, args.ingest, args.workers)
+    if "skipped" in results:
+        print(f"Skipped the database benchmarks. {results['skipped']}")
+
+    output_paths = [args.output] + ([args.baseline] if args.save_baseline else [])
+    for path in output_paths:
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as output_file:
+            json.dump(results, output_file, indent=2)
+    print(f"Results written to {', '.join(output_paths)}")
+
+    if args.save_baseline or not os.path.exists(args.baseline):
+        for path, seconds in flatten(results).items():
+            print(f"{path}: {seconds * 1000:.1f} ms")
+        return
+
+    with open(args.baseline) as baseline_file:
+        comparison = compare(results, json.load(baseline_file), args.tolerance)
+    for metric in comparison:
+        flag = "REGRESSION" if metric["regression"] else ""
+        print(f"{metric['metric']}: {metric['seconds'] * 1000:.1f} ms ({metric['ratio']:.2f}x baseline) {flag}".rstrip())
+
+    # A non-zero exit code lets a deployment script stop on a regression
+    if any(metric["regression"] for metric in comparison):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
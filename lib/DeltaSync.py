@@ -0,0 +1,137 @@
+import argparse
+import hashlib
+import json
+import os
+
+import pandas as pd
+import yaml
+from yaml.loader import SafeLoader
+
+from lib.GraphDB import GraphDB
+from lib import Pipeline
+
+class DeltaSync:
+    # Keeps the graph in line with the processed csv files by only writing the rows
+    # that changed since the last sync, the fingerprints of the loaded rows are kept in a manifest
+    def __init__(self, graph_db: GraphDB, manifest_path: str = "data/processed/graph_manifest.json"):
+        self.graph_db = graph_db
+        self.manifest_path = manifest_path
+
+    def sync(self, sa2_data: pd.DataFrame, hospital_data: pd.DataFrame, edges: pd.DataFrame, batch_size: int = 1000) -> dict:
+        manifest = self.load_manifest()
+
+        sa2_rows = {row["id"]: row for row in GraphDB.sa2_rows(sa2_data)}
+        hospital_rows = {row["id"]: row for row in GraphDB.hospital_rows(hospital_data)}
+        # Edges of nodes that are not in the files are never in the graph: the MATCH of a new edge finds
+        # nothing, and deleting a node takes its edges with it. They are left out of the manifest too,
+        # else adding the node again would not recreate its unchanged edges
+        edge_rows = {
+            self.edge_key(row): row for row in GraphDB.edge_rows(edges)
+            if row["hospital_id"] in hospital_rows and row["sa2_5dig"] in sa2_rows
+            }
+
+        sa2_changed, sa2_removed, sa2_hashes = self.diff(sa2_rows, manifest["SA2"])
+        hospitals_changed, hospitals_removed, hospital_hashes = self.diff(hospital_rows, manifest["Hospital"])
+        edges_changed, edges_removed, edge_hashes = self.diff(edge_rows, manifest["REACHABLE_VIA"])
+
+        # Nodes first so the new edges can find them, deleted nodes last as they take their edges with them
+        report = {
+            "sa2_upserted": self.graph_db.upsert_sa2(sa2_changed, batch_size)["rows"],
+            "hospitals_upserted": self.graph_db.upsert_hospitals(hospitals_changed, batch_size)["rows"],
+            "edges_upserted": self.graph_db.upsert_edges(edges_changed, batch_size)["rows"],
+            "edges_deleted": self.graph_db.delete_edges(
+                (key.split("|") for key in edges_removed), batch_size
+                )["rows"],
+            "sa2_deleted": self.graph_db.delete_sa2(sa2_removed, batch_size)["rows"],
+            "hospitals_deleted": self.graph_db.delete_hospitals(hospitals_removed, batch_size)["rows"]
+            }
+
+        # Refresh the precomputed summaries of the hospitals and SA2s touched by the changes
+        changed_hospitals = {row["id"] for row in hospitals_changed}
+        affected_sa2 = {row["id"] for row in sa2_changed}
+        affected_sa2.update(row["sa2_5dig"] for row in edges_changed)
+        affected_sa2.update(key.split("|")[1] for key in edges_removed)
+        affected_sa2.update(row["sa2_5dig"] for row in edge_rows.values() if row["hospital_id"] in changed_hospitals)
+        if changed_hospitals or affected_sa2:
+            self.graph_db.materialize_accessibility(
+                hospital_ids=list(changed_hospitals),
+                sa2_ids=list(affected_sa2)
+                )
+        report["sa2_refreshed"] = len(affected_sa2)
+        # A graph restored from a dump has no summaries at all, they are computed for every node once
+        report["summaries_materialized"] = self.graph_db.materialize_missing()
+
+        # Only remember the new state once everything is written
+        self.save_manifest({
+            "SA2": sa2_hashes,
+            "Hospital": hospital_hashes,
+            "REACHABLE_VIA": edge_hashes
+            })
+        return report
+
+    @staticmethod
+    def edge_key(row: dict) -> str:
+        return f"{row['hospital_id']}|{row['sa2_5dig']}"
+
+    @classmethod
+    def diff(cls, rows: dict, loaded: dict) -> tuple:
+        # Returns the new or changed rows, the keys that are no longer present and the new fingerprints
+        hashes = {key: cls.fingerprint(row) for key, row in rows.items()}
+        changed = [rows[key] for key, value in hashes.items() if loaded.get(key) != value]
+        removed = [key for key in loaded if key not in hashes]
+        return changed, removed, hashes
+
+    @staticmethod
+    def fingerprint(row: dict) -> str:
+        return hashlib.sha1(json.dumps(row, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+    def load_manifest(self) -> dict:
+        manifest = {"SA2": {}, "Hospital": {}, "REACHABLE_VIA": {}}
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as manifest_file:
+                manifest.update(json.load(manifest_file))
+        return manifest
+
+    def save_manifest(self, manifest: dict):
+        # Write to a temporary file first so an interrupted sync never leaves a broken manifest
+        temp_path = f"{self.manifest_path}.tmp"
+        with open(temp_path, "w") as manifest_file:
+            json.dump(manifest, manifest_file)
+        os.replace(temp_path, self.manifest_path)
+
+def main():
+    parser = argparse.ArgumentParser(description="Write the changes in the processed csv files to the graph")
+    parser.add_argument("--savedir", default="data/processed", help="Directory with the processed csv files")
+    parser.add_argument("--config", default="config.yaml", help="Configuration file with the database settings")
+    parser.add_argument("--manifest", default=None, help="Manifest of the last sync, defaults to <savedir>/graph_manifest.json")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    args = parser.parse_args()
+
+    with open(args.config) as config_file:
+        config = yaml.load(config_file, Loader=SafeLoader)
+
+    graph_db = GraphDB(
+        uri=config["DATABASE"]["URI"],
+        user=config["DATABASE"]["USER"],
+        password=config["DATABASE"]["PASSWORD"],
+        database=config["DATABASE"]["DBNAME"]
+        )
+
+    sa2_data = pd.read_csv(os.path.join(args.savedir, "SA2PopulationData.csv"))
+    hospital_data = pd.read_csv(os.path.join(args.savedir, "HospitalMetadata.csv"))
+    edges = Pipeline.edge_list(
+        pd.read_csv(os.path.join(args.savedir, "HospitalDistance.csv")),
+        pd.read_csv(os.path.join(args.savedir, "AccessibilityEdges.csv"))
+        )
+
+    manifest_path = args.manifest or os.path.join(args.savedir, "graph_manifest.json")
+    try:
+        report = DeltaSync(graph_db, manifest_path).sync(sa2_data, hospital_data, edges, args.batch_size)
+    finally:
+        graph_db.close()
+
+    for key, value in report.items():
+        print(f"{key}: {value}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+from neo4j import GraphDatabase
+
+import threading
+import time
+
+class DriverPool:
+    # One neo4j driver (and so one connection pool) per process and database server,
+    # every GraphDB borrows sessions from it instead of opening its own pool
+    _drivers = {}
+    _lock = threading.Lock()
+
+    @classmethod
+    def acquire(cls, uri: str, user: str, password: str, pool_config: dict | None = None):
+        pool_config = pool_config or {}
+        key = (uri, user, password, tuple(sorted(pool_config.items())))
+
+        with cls._lock:
+            if key in cls._drivers:
+                cls._drivers[key]["references"] += 1
+                return cls._drivers[key]["driver"]
+
+        # Check the connection without holding the lock, an unreachable server must not block other sessions
+        driver = GraphDatabase.driver(uri, auth=(user, password), **pool_config)
+        try:
+            driver.verify_connectivity()
+        except Exception:
+            driver.close()
+            raise
+
+        with cls._lock:
+            if key in cls._drivers:
+                # Another session connected at the same time, keep its driver
+                driver.close()
+            else:
+                cls._drivers[key] = {
+                    "driver": driver,
+                    "references": 0,
+                    "waits": WaitStats()
+                    }
+                cls._measure_acquisition(driver, cls._drivers[key]["waits"])
+            cls._drivers[key]["references"] += 1
+            return cls._drivers[key]["driver"]
+
+    @classmethod
+    def release(cls, driver):
+        # Close the driver once the last GraphDB using it is closed
+        with cls._lock:
+            for key, entry in list(cls._drivers.items()):
+                if entry["driver"] is driver:
+                    entry["references"] -= 1
+                    if entry["references"] <= 0:
+                        del cls._drivers[key]
+                        driver.close()
+                    return
+        driver.close()
+
+    @classmethod
+    def stats(cls, driver) -> dict:
+        with cls._lock:
+            entry = next((entry for entry in cls._drivers.values() if entry["driver"] is driver), None)
+        if entry is None:
+            return {}
+
+        in_use, idle = None, None
+        try:
+            # The driver has no public pool metrics, so we read them from the pool itself
+            connections = [
+                connection
+                for address_connections in list(driver._pool.connections.values())
+                for connection in list(address_connections)
+                ]
+            in_use = sum(1 for connection in connections if connection.in_use)
+            idle = len(connections) - in_use
+        except AttributeError:
+            pass
+
+        return {
+            "references": entry["references"],
+            "in_use": in_use,
+            "idle": idle,
+            **entry["waits"].summary()
+            }
+
+    @staticmethod
+    def _measure_acquisition(driver, waits):
+        # Time every connection acquisition, this is the time a session waits for the pool
+        try:
+            pool = driver._pool
+            acquire = pool.acquire
+        except AttributeError:
+            return
+
+        def timed_acquire(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return acquire(*args, **kwargs)
+            finally:
+                waits.add(time.perf_counter() - start)
+
+        pool.acquire = timed_acquire
+
+class WaitStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds: float):
+        with self._lock:
+            self.count += 1
+            self.total += seconds
+            self.max = max(self.max, seconds)
+
+    def summary(self) -> dict:
+        with self._lock:
+            return {
+                "acquisitions": self.count,
+                "avg_wait_ms": round(self.total / self.count * 1000, 2) if self.count > 0 else None,
+                "max_wait_ms": round(self.max * 1000, 2)
+                }
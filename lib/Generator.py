@@ -0,0 +1,203 @@
+import argparse
+import math
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from lib import Geo, Pipeline
+from lib.TravelTimeStore import TravelTimeStore
+
+# Road speed of the raw travel times, the calibration maps them onto the observed travel times
+SECONDS_PER_KILOMETRE = 60.0
+
+# Spread of a synthetic hospital around the hospital it was sampled from, and of the raw travel times
+JITTER_KILOMETRES = 5.0
+TRAVEL_TIME_NOISE = 0.1
+
+# Every copy of the hospital network gets its own tile of the plane, the margin keeps
+# the tiles so far apart that edges between them are never among the closest
+TILE_MARGIN_KILOMETRES = 2000.0
+
+# Number of SA2 regions used to fit the travel time calibration
+CALIBRATION_SAMPLE = 2000
+
+class Generator:
+    # Generates SA2 regions, hospitals and their travel times at any scale, statistically similar to the
+    # processed data: hospitals are sampled per copy of the real network so their density stays the same,
+    # SA2 regions are placed around a hospital at an observed shortest travel time, and the raw travel
+    # times are mapped onto the observed distribution of the closest hospitals
+    def __init__(self, datadir: str = "data/processed", seed: int = 0, k: int = 5):
+        self.rng = np.random.default_rng(seed)
+        self.k = k
+
+        self.sa2_data = pd.read_csv(os.path.join(datadir, "SA2PopulationData.csv"))
+        self.hospital_data = pd.read_csv(os.path.join(datadir, "HospitalMetadata.csv"))
+        distances = pd.read_csv(os.path.join(datadir, "HospitalDistance.csv"))
+
+        # Observed travel times of the closest hospitals and the shortest one per SA2
+        self.observed = Pipeline.edge_list(distances)["distance_time"].to_numpy()
+        self.shortest = pd.to_numeric(distances["shortest_time_sec"], errors="coerce").dropna().to_numpy()
+
+        self.raw_quantiles = None
+        self.observed_quantiles = None
+
+    def hospitals(self, n: int) -> tuple:
+        # Sample n hospitals, the i-th copy of the network is moved to its own tile
+        base = self.hospital_data
+        hospitals = base.iloc[self.rng.integers(0, len(base), n)].reset_index(drop=True)
+        hospitals["hospital_ID"] = np.arange(1, n + 1)
+        hospitals["hospital_name"] = hospitals["hospital_name"] + " (" + hospitals["hospital_ID"].astype(str) + ")"
+
+        x, y = Geo.to_kilometres(hospitals["latitude"].to_numpy(), hospitals["longitude"].to_numpy())
+        x = x + self.rng.normal(0, JITTER_KILOMETRES, n)
+        y = y + self.rng.normal(0, JITTER_KILOMETRES, n)
+        # Every copy keeps the coordinates of the real region, the tiles below only exist on the plane
+        hospitals["latitude"], hospitals["longitude"] = Geo.from_kilometres(x, y)
+
+        base_x, base_y = Geo.to_kilometres(base["latitude"].to_numpy(), base["longitude"].to_numpy())
+        tiles = np.arange(n) // len(base)
+        columns = math.ceil(math.sqrt(tiles[-1] + 1)) if n > 0 else 1
+        x = x + (tiles % columns) * (np.ptp(base_x) + TILE_MARGIN_KILOMETRES)
+        y = y + (tiles // columns) * (np.ptp(base_y) + TILE_MARGIN_KILOMETRES)
+
+        # The tiled positions the travel times are computed from, kept apart from the coordinates
+        # as far tiles would leave the range of real latitudes and longitudes
+        hospitals["x_km"], hospitals["y_km"] = x, y
+        return hospitals, np.column_stack([x, y])
+
+    def sa2s(self, n: int, hospital_positions: np.ndarray) -> tuple:
+        # Sample n SA2 regions and place each one around a random hospital at an observed shortest travel time
+        base = self.sa2_data
+        sa2 = base.iloc[self.rng.integers(0, len(base), n)].reset_index(drop=True)
+        sa2["SA2_5DIG"] = np.arange(10000, 10000 + n)
+        sa2["SA2_name"] = sa2["SA2_name"] + " (" + sa2["SA2_5DIG"].astype(str) + ")"
+        sa2["SA2_population"] = np.round(sa2["SA2_population"] * self.rng.lognormal(0, 0.2, n))
+        sa2["SA2_population_percentage"] = sa2["SA2_population"] / sa2["SA2_population"].sum() * 100
+        sa2["SA2_population_density"] = (sa2["SA2_population"] / sa2["SA2_area"]).round(1)
+
+        anchors = self.rng.integers(0, len(hospital_positions), n)
+        radius = self.rng.choice(self.shortest, n) / SECONDS_PER_KILOMETRE
+        bearing = self.rng.uniform(0, 2 * math.pi, n)
+        positions = hospital_positions[anchors] + np.column_stack([radius * np.cos(bearing), radius * np.sin(bearing)])
+        return sa2, positions
+
+    def raw_travel_times(self, sa2_positions: np.ndarray, hospital_positions: np.ndarray) -> np.ndarray:
+        # Straight line distance at road speed with some noise per pair, as a SA2 x hospital matrix
+        distance = np.sqrt(
+            (sa2_positions[:, 0, None] - hospital_positions[None, :, 0]) ** 2
+            + (sa2_positions[:, 1, None] - hospital_positions[None, :, 1]) ** 2
+            )
+        noise = self.rng.lognormal(0, TRAVEL_TIME_NOISE, distance.shape)
+        return distance * SECONDS_PER_KILOMETRE * noise
+
+    def calibrate(self, sa2_positions: np.ndarray, hospital_positions: np.ndarray, quantiles: int = 201):
+        # Fit a monotone mapping from the raw travel times of the k closest hospitals to the observed ones,
+        # the order of the hospitals is kept so the closest hospitals stay the same
+        sample = sa2_positions[self.rng.choice(len(sa2_positions), min(CALIBRATION_SAMPLE, len(sa2_positions)), replace=False)]
+        raw = self.raw_travel_times(sample, hospital_positions)
+        k = min(self.k, raw.shape[1])
+        closest = np.partition(raw, k - 1, axis=1)[:, :k].ravel()
+
+        levels = np.linspace(0, 1, quantiles)
+        self.raw_quantiles = np.maximum.accumulate(np.quantile(closest, levels)) + np.arange(quantiles) * 1e-9
+        self.observed_quantiles = np.quantile(self.observed, levels)
+
+    def travel_times(self, raw: np.ndarray) -> np.ndarray:
+        # Apply the calibration, beyond the fitted range the travel times grow proportionally
+        mapped = np.interp(raw, self.raw_quantiles, self.observed_quantiles)
+        above = raw > self.raw_quantiles[-1]
+        mapped[above] = raw[above] * self.observed_quantiles[-1] / self.raw_quantiles[-1]
+        return mapped
+
+    def generate(
+        self, savedir: str, n_sa2: int, n_hospitals: int, chunk_cells: int = 2_000_000,
+        matrix: bool = False, store: bool = False
+        ) -> dict:
+        # Write the csv files of the processed data, the travel times are computed and
+        # appended per chunk of SA2 regions so memory stays bounded by chunk_cells
+        start = time.perf_counter()
+        os.makedirs(savedir, exist_ok=True)
+
+        hospitals, hospital_positions = self.hospitals(n_hospitals)
+        sa2, sa2_positions = self.sa2s(n_sa2, hospital_positions)
+        self.calibrate(sa2_positions, hospital_positions)
+
+        hospitals.to_csv(os.path.join(savedir, "HospitalMetadata.csv"), index=False)
+        sa2.to_csv(os.path.join(savedir, "SA2PopulationData.csv"), index=False)
+
+        hospital_ids = hospitals["hospital_ID"].to_numpy()
+        hospital_columns = [f"duration_hospital_{hospital_id}" for hospital_id in hospital_ids]
+        sa2_ids = sa2["SA2_5DIG"].to_numpy()
+        rows_per_chunk = max(1, chunk_cells // max(1, n_hospitals))
+        k = min(self.k, n_hospitals)
+        time_store = TravelTimeStore.create(os.path.join(savedir, "travel_times"), hospital_ids, keep_nearest=k) if store else None
+
+        closest_count, accessible_count, far_count = 0, 0, 0
+        for chunk_start in range(0, n_sa2, rows_per_chunk):
+            chunk = slice(chunk_start, chunk_start + rows_per_chunk)
+            first = chunk_start == 0
+            durations = self.travel_times(self.raw_travel_times(sa2_positions[chunk], hospital_positions))
+
+            closest = Pipeline.closest_hospitals(sa2_ids[chunk], hospital_ids, durations, k)
+            closest.insert(1, "shortest_time_sec", durations.min(axis=1))
+            closest.to_csv(os.path.join(savedir, "HospitalDistance.csv"), mode="w" if first else "a", header=first, index=False)
+
+            Pipeline.accessibility_edges(sa2_ids[chunk], hospital_ids, durations).to_csv(
+                os.path.join(savedir, "AccessibilityEdges.csv"), mode="w" if first else "a", header=first, index=False
+                )
+
+            # The full matrix in the layout of the raw duration data read by Pipeline.distance_matrix
+            if matrix:
+                wide = pd.DataFrame(durations, columns=hospital_columns)
+                wide.insert(0, "SA2_5DIG16", sa2_ids[chunk])
+                wide.to_csv(os.path.join(savedir, "duration_sa2_hospitals.csv"), mode="w" if first else "a", header=first, index=False)
+
+            if time_store is not None:
+                time_store.append(sa2_ids[chunk], durations)
+
+            # Keep track of the travel times of the closest hospitals to compare them with the observed ones
+            nearest = np.partition(durations, k - 1, axis=1)[:, :k]
+            closest_count += nearest.size
+            accessible_count += int((nearest < Pipeline.ACCESSIBLE_SECONDS).sum())
+            far_count += int((nearest > Pipeline.FAR_SECONDS).sum())
+
+        if time_store is not None:
+            time_store.finish()
+
+        return {
+            "sa2": n_sa2,
+            "hospitals": n_hospitals,
+            "edges": n_sa2 * n_hospitals,
+            "seconds": time.perf_counter() - start,
+            "accessible_ratio": accessible_count / max(1, closest_count),
+            "observed_accessible_ratio": float((self.observed < Pipeline.ACCESSIBLE_SECONDS).mean()),
+            "further_than_2h_ratio": far_count / max(1, closest_count),
+            "observed_further_than_2h_ratio": float((self.observed > Pipeline.FAR_SECONDS).mean())
+            }
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate synthetic SA2, hospital and travel time data at any scale")
+    parser.add_argument("--datadir", default="data/processed", help="Directory with the processed csv files to sample from")
+    parser.add_argument("--savedir", default="data/synthetic", help="Directory to write the csv files to")
+    parser.add_argument("--scale", type=float, default=1.0, help="Size relative to the processed data")
+    parser.add_argument("--sa2", type=int, default=None, help="Number of SA2 regions, overrides the scale")
+    parser.add_argument("--hospitals", type=int, default=None, help="Number of hospitals, overrides the scale")
+    parser.add_argument("--top-k", type=int, default=5, help="Number of closest hospitals to keep per SA2")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--chunk-cells", type=int, default=2_000_000, help="Travel times computed and written at once")
+    parser.add_argument("--matrix", action="store_true", help="Also write the full travel time matrix")
+    parser.add_argument("--store", action="store_true", help="Also write the travel times as a TravelTimeStore")
+    args = parser.parse_args()
+
+    generator = Generator(args.datadir, args.seed, args.top_k)
+    n_sa2 = args.sa2 or round(len(generator.sa2_data) * args.scale)
+    n_hospitals = args.hospitals or round(len(generator.hospital_data) * args.scale)
+
+    report = generator.generate(args.savedir, n_sa2, n_hospitals, args.chunk_cells, args.matrix, args.store)
+    for key, value in report.items():
+        print(f"{key}: {value:.3f}" if isinstance(value, float) else f"{key}: {value}")
+
+if __name__ == "__main__":
+    main()
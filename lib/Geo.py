@@ -0,0 +1,62 @@
+import math
+
+import numpy as np
+
+# Projection settings for the graph layout, the reference latitude is the middle of Australia
+REFERENCE_LATITUDE = -25.0
+PIXELS_PER_DEGREE = 100.0
+
+# Kilometres per degree of latitude for distances on the projected plane, the earth radius for great circle distances
+KILOMETRES_PER_DEGREE = 111.2
+EARTH_RADIUS_KILOMETRES = 6371.0
+
+def valid_coordinates(latitude, longitude) -> bool:
+    return (
+        isinstance(latitude, (int, float)) and isinstance(longitude, (int, float))
+        and not math.isnan(latitude) and not math.isnan(longitude)
+        )
+
+def project(latitude: float, longitude: float) -> dict:
+    # Equirectangular projection to screen coordinates, y points down in the browser
+    return {
+        "x": round(longitude * math.cos(math.radians(REFERENCE_LATITUDE)) * PIXELS_PER_DEGREE, 1),
+        "y": round(-latitude * PIXELS_PER_DEGREE, 1)
+        }
+
+def to_kilometres(latitude, longitude) -> tuple:
+    # Equirectangular projection in kilometres, accurate enough for travel time estimates
+    # within a region and works on numbers and numpy arrays alike
+    return (
+        longitude * math.cos(math.radians(REFERENCE_LATITUDE)) * KILOMETRES_PER_DEGREE,
+        latitude * KILOMETRES_PER_DEGREE
+        )
+
+def from_kilometres(x, y) -> tuple:
+    # Inverse of to_kilometres, returns latitude and longitude
+    return (
+        y / KILOMETRES_PER_DEGREE,
+        x / (math.cos(math.radians(REFERENCE_LATITUDE)) * KILOMETRES_PER_DEGREE)
+        )
+
+def haversine(latitude_1, longitude_1, latitude_2, longitude_2):
+    # Great circle distance in kilometres, works on numbers and numpy arrays alike
+    latitude_1, longitude_1, latitude_2, longitude_2 = map(np.radians, (latitude_1, longitude_1, latitude_2, longitude_2))
+    a = (
+        np.sin((latitude_2 - latitude_1) / 2) ** 2
+        + np.cos(latitude_1) * np.cos(latitude_2) * np.sin((longitude_2 - longitude_1) / 2) ** 2
+        )
+    return 2 * EARTH_RADIUS_KILOMETRES * np.arcsin(np.sqrt(a))
+
+def to_unit_vectors(latitude, longitude) -> np.ndarray:
+    # Points on the unit sphere, the straight line (chord) distance between them grows with the
+    # great circle distance so a KD-tree over them finds the nearest points on the earth
+    latitude, longitude = np.radians(latitude), np.radians(longitude)
+    return np.column_stack([
+        np.cos(latitude) * np.cos(longitude),
+        np.cos(latitude) * np.sin(longitude),
+        np.sin(latitude)
+        ])
+
+def chord_length(kilometres):
+    # The chord on the unit sphere of a great circle distance, the radius for a KD-tree ball query
+    return 2 * np.sin(np.minimum(kilometres / EARTH_RADIUS_KILOMETRES, math.pi) / 2)
@@ -1,15 +1,125 @@
-from neo4j import GraphDatabase
-import streamlit as st
+from neo4j import Query
+from neo4j.exceptions import Neo4jError
+from neo4j.graph import Node, Relationship
+
+from array import array
+from itertools import islice
+import math
+import re
+import time
+import weakref
+
+import numpy as np
+import pandas as pd
+
+from lib.DriverPool import DriverPool
+from lib.QueryCache import QueryCache
+from lib.QueryJob import QueryJob
+
+# Example queries that return a table instead of hospital, sa2 and relation
+TABULAR_QUERIES = [
+    "most_accessible",
+    "population_to_beds",
+    "least_hospitals",
+    "distance_ratio",
+    "population_to_beds_fast",
+    "least_hospitals_fast",
+    "distance_ratio_fast"
+]
+
+# Uniqueness constraints on the node ids and range indexes on the properties
+# the example queries filter and sort on
+SCHEMA = [
+    "CREATE CONSTRAINT sa2_id IF NOT EXISTS FOR (s:SA2) REQUIRE s.id IS UNIQUE",
+    "CREATE CONSTRAINT hospital_id IF NOT EXISTS FOR (h:Hospital) REQUIRE h.id IS UNIQUE",
+    "CREATE RANGE INDEX hospital_state IF NOT EXISTS FOR (h:Hospital) ON (h.state)",
+    "CREATE RANGE INDEX sa2_name IF NOT EXISTS FOR (s:SA2) ON (s.sa2_name)",
+    "CREATE RANGE INDEX sa2_accessible_hospital_count IF NOT EXISTS FOR (s:SA2) ON (s.accessible_hospital_count)",
+    "CREATE RANGE INDEX sa2_hospital_count IF NOT EXISTS FOR (s:SA2) ON (s.hospital_count)",
+    "CREATE RANGE INDEX reachable_via_accessible IF NOT EXISTS FOR ()-[r:REACHABLE_VIA]-() ON (r.accessible)",
+    "CREATE RANGE INDEX reachable_via_distance_time IF NOT EXISTS FOR ()-[r:REACHABLE_VIA]-() ON (r.distance_time)"
+]
+
+# Column holding the keyset of a paged query, a page continues after the key of the last row of the previous page
+PAGE_KEY = "page_key"
+
+# A plain query over one directed, named relationship: MATCH (h)-[r:REACHABLE_VIA]->(s) [WHERE ...] RETURN h, r, s.
+# Every row of such a query is one relationship, so the rows can be paged on the element id of the relationship
+NODE_PATTERN = r"\(\s*(?:[A-Za-z_]\w*)?(?:\s*:\s*\w+)*\s*(?:\{[^{}]*\})?\s*\)"
+RELATIONSHIP_PATTERN = r"\[\s*(?P<relationship>[A-Za-z_]\w*)\s*(?::\s*[\w|]+)?\s*(?:\{[^{}]*\})?\s*\]"
+PLAIN_MATCH = re.compile(
+    rf"^(?P<match>MATCH\s*{NODE_PATTERN}\s*(?:<-\s*{RELATIONSHIP_PATTERN}\s*-|-\s*{RELATIONSHIP_PATTERN.replace('relationship', 'outgoing')}\s*->)\s*{NODE_PATTERN}"
+    r"(?:\s+WHERE\s+.*?)?)\s+RETURN\s+(?P<items>[\w\s,]+)$",
+    re.IGNORECASE | re.DOTALL
+    )
+# Clauses and functions that change which rows a query returns or their order
+NOT_PAGEABLE = re.compile(
+    r"(?<!STARTS )(?<!ENDS )\b(?:ORDER\s+BY|SKIP|LIMIT|UNION|WITH|UNWIND|CALL|DISTINCT|CREATE|MERGE|SET|DELETE|REMOVE|FOREACH|"
+    r"count|sum|avg|min|max|collect|stDev\w*|percentile\w*)\b",
+    re.IGNORECASE
+    )
 
 class GraphDB:
-    def __init__(self, uri, user, password, database):
-        # self.driver = GraphDatabase.driver(uri, auth=(user, password))
-        self.driver = GraphDatabase.driver(uri, auth=(user, password))
-        self.driver.verify_connectivity()
+    def __init__(self, uri, user, password, database, cache: QueryCache | None = None, pool_config: dict | None = None):
+        # Borrow the process wide driver, only the first GraphDB pays for the connectivity check
+        self.driver = DriverPool.acquire(uri, user, password, pool_config)
         self.database = database
 
+        # The driver is released once, by close() or when the GraphDB is garbage collected,
+        # e.g. when a dashboard session ends without closing it
+        self._release = weakref.finalize(self, DriverPool.release, self.driver)
+        
+        # Optional (shared) result cache in front of run_query and fetch_data
+        self.cache = cache
+
+        # Schema statements that failed in the last ensure_schema, e.g. for a user without schema rights
+        self.schema_errors = []
+
     def close(self):
-        self.driver.close()
+        self._release()
+
+    def pool_stats(self) -> dict:
+        return DriverPool.stats(self.driver)
+
+    ### SCHEMA
+    def ensure_schema(self, queries: dict | None = None) -> dict:
+        # Create the constraints and indexes, optionally report the indexes used by the given queries
+        # A statement that fails is skipped and kept in schema_errors, the graph can be queried without it
+        self.schema_errors = []
+        with self.driver.session(database=self.database) as session:
+            for statement in SCHEMA + ["CALL db.awaitIndexes(300)"]:
+                try:
+                    session.run(statement).consume()
+                except Neo4jError as e:
+                    self.schema_errors.append(f"{statement}: {e.message}")
+        
+        # A graph restored from a dump has none of the properties the *_fast example queries read. They are
+        # only reported here, writing them is left to the loaders and DeltaSync
+        try:
+            if self.summaries_missing():
+                self.schema_errors.append("the SA2 summaries are missing, run python -m lib.DeltaSync to compute them")
+        except Neo4jError as e:
+            self.schema_errors.append(f"summaries_missing: {e.message}")
+        
+        if queries is None:
+            return {}
+        return {key: self.index_usage(query) for key, query in queries.items()}
+
+    def index_usage(self, query: str) -> list:
+        # Run EXPLAIN on the query and collect the index operators of the plan
+        with self.driver.session(database=self.database) as session:
+            plan = session.run(f"EXPLAIN {query}").consume().plan
+        
+        used = []
+        stack = [plan] if plan else []
+        while stack:
+            operator = stack.pop()
+            operator_type = operator["operatorType"].split("@")[0]
+            if "Index" in operator_type:
+                details = operator.get("args", operator.get("arguments", {})).get("Details", "")
+                used.append(f"{operator_type}: {details}")
+            stack.extend(operator.get("children", []))
+        return used
 
     ### COMPANY
     def create_sa2(self, sa2_5dig, sa2_name, area, population, pop_percentage, pop_density):
@@ -67,68 +177,650 @@ class GraphDB:
         )
         tx.run(query, hospital_id=hospital_id, sa2_5dig=sa2_5dig, distance_time=float(distance_time), accessible=accessible, further_than_2h=further_than_2h)
       
-    def run_query(self, query: str, query_limit: int, example_key: str) -> list | Exception:
-        with self.driver.session(database=self.database) as session:     
-            graph = []   
+    ### BULK INGESTION
+    def bulk_load_sa2(self, df, batch_size: int = 1000) -> dict:
+        # MERGE on the id, so loading the same file twice does not create a second node per SA2
+        return self._write_batches(self._merge_sa2_batch, self.sa2_rows(df), batch_size)
+
+    @classmethod
+    def sa2_rows(cls, df):
+        # SA2PopulationData rows as SA2 node properties, one row per id
+        return ({
+            "id": str(row["SA2_5DIG"]),
+            "sa2_name": row["SA2_name"],
+            "area": row["SA2_area"],
+            "population": row["SA2_population"],
+            "pop_percentage": row["SA2_population_percentage"],
+            "pop_density": row["SA2_population_density"]
+            } for row in cls._records(cls.merge_duplicate_sa2(df)))
+
+    @staticmethod
+    def merge_duplicate_sa2(df):
+        # Some 2021 SA2 regions share the 5 digit id of the 2016 region the travel times were computed for
+        # (e.g. 11011 is Googong and Queanbeyan Surrounds). They are merged into one region with the
+        # names joined and the areas and populations added up, so the id stays a unique key
+        if df["SA2_5DIG"].isna().any():
+            raise ValueError("SA2 rows without an SA2_5DIG id")
+        ids = df["SA2_5DIG"].astype(str)
+        if not ids.duplicated().any():
+            return df
+
+        merged = df.assign(SA2_5DIG=ids).groupby("SA2_5DIG", sort=False).agg(
+            SA2_name=("SA2_name", lambda names: " / ".join(dict.fromkeys(names.astype(str)))),
+            SA2_area=("SA2_area", lambda values: values.sum(min_count=1)),
+            SA2_population=("SA2_population", lambda values: values.sum(min_count=1)),
+            SA2_population_percentage=("SA2_population_percentage", lambda values: values.sum(min_count=1))
+            ).reset_index()
+        merged["SA2_population_density"] = (merged["SA2_population"] / merged["SA2_area"]).round(1)
+        return merged
+
+    def bulk_load_hospitals(self, df, batch_size: int = 1000) -> dict:
+        # Like the SA2s, MERGE on the id so a reload updates the hospitals instead of failing on the constraint
+        return self._write_batches(self._merge_hospital_batch, self.hospital_rows(df), batch_size)
+
+    @classmethod
+    def hospital_rows(cls, df):
+        # HospitalMetadata rows as Hospital node properties
+        return ({
+            "id": str(row["hospital_ID"]),
+            "hospital_name": row["hospital_name"],
+            "phone_number": row["phone_number"],
+            "address": row["address"],
+            "suburb": row["suburb"],
+            "postcode": row["postcode"],
+            "state": row["state"],
+            "lhn": row["local_hospital_network"],
+            "phn": row["primary_health_network"],
+            "website": row["website"],
+            "description": row["description"],
+            "sector": row["sector"],
+            "beds": row["beds"],
+            "latitude": row["latitude"],
+            "longitude": row["longitude"]
+            } for row in cls._records(df))
+
+    def bulk_load_edges(self, df, batch_size: int = 5000) -> dict:
+        # MERGE so loading the same edges again does not add a second REACHABLE_VIA between the same nodes
+        report = self._write_batches(self._merge_relation_sa2_hospital_batch, self.edge_rows(df), batch_size)
+        
+        # The edges changed, so the precomputed summaries have to be refreshed
+        self.materialize_accessibility()
+        return report
+
+    @classmethod
+    def edge_rows(cls, df):
+        # Expects one row per edge with the columns
+        # SA2_5DIG, hospital_ID, distance_time, accessible and further_than_2h
+        return ({
+            "hospital_id": str(row["hospital_ID"]),
+            "sa2_5dig": str(row["SA2_5DIG"]),
+            "distance_time": float(row["distance_time"]),
+            "accessible": bool(row["accessible"]),
+            "further_than_2h": bool(row["further_than_2h"])
+            } for row in cls._records(df))
+
+    ### MATERIALIZED SUMMARIES
+    def materialize_accessibility(self, hospital_ids: list | None = None, sa2_ids: list | None = None):
+        # Refresh everything by default, or only the given hospitals and SA2s after an incremental update
+        self.refresh_hospital_beds(hospital_ids)
+        self.refresh_sa2_summary(sa2_ids)
+
+    def summaries_missing(self) -> bool:
+        # Whether some SA2 has no summary yet, only reads the graph
+        with self.driver.session(database=self.database) as session:
+            return session.run(
+                "MATCH (s:SA2) WHERE s.hospital_count IS NULL RETURN count(s) > 0 AS missing"
+                ).single()["missing"]
+
+    def materialize_missing(self) -> bool:
+        # Materialize once when some SA2 has no summary yet, the loaders and DeltaSync keep it up to date afterwards
+        missing = self.summaries_missing()
+        if missing:
+            self.materialize_accessibility()
+        return missing
+
+    def refresh_hospital_beds(self, hospital_ids: list | None = None):
+        # Parse the beds category ("<50", "50-99", ">500") once into numbers,
+        # an open ended category uses its bound for both values
+        query = (
+            "MATCH (h:Hospital) WHERE $ids IS NULL OR h.id IN $ids "
+            "CALL { "
+            "  WITH h "
+            "  WITH h, toString(h.beds) AS beds "
+            "  WITH h, CASE "
+            "    WHEN beds STARTS WITH '<' THEN [0, toInteger(substring(beds, 1))] "
+            "    WHEN beds STARTS WITH '>' THEN [toInteger(substring(beds, 1)), toInteger(substring(beds, 1))] "
+            "    WHEN beds CONTAINS '-' THEN [toInteger(split(beds, '-')[0]), toInteger(split(beds, '-')[1])] "
+            "    ELSE [toInteger(beds), toInteger(beds)] "
+            "  END AS bounds "
+            "  SET h.beds_min = bounds[0], h.beds_max = bounds[1] "
+            "} IN TRANSACTIONS OF 1000 ROWS"
+        )
+        self._run_write(query, ids=hospital_ids)
+
+    def refresh_sa2_summary(self, sa2_ids: list | None = None):
+        # Store the statistics of the incoming REACHABLE_VIA edges on every SA2, the SA2 has no
+        # coordinates of its own so its centroid is estimated from its hospitals weighted by travel time
+        query = (
+            "MATCH (s:SA2) WHERE $ids IS NULL OR s.id IN $ids "
+            "CALL { "
+            "  WITH s "
+            "  OPTIONAL MATCH (s)<-[r:REACHABLE_VIA]-(h:Hospital) "
+            "  WITH s, MIN(r.distance_time) AS closest, MAX(r.distance_time) AS furthest, "
+            "    COUNT(DISTINCT h) AS hospitals, "
+            "    COUNT(DISTINCT CASE WHEN r.accessible THEN h END) AS accessible_hospitals, "
+            "    SUM(h.beds_max) AS total_beds, "
+            "    SUM(CASE WHEN h.latitude IS NOT NULL AND h.longitude IS NOT NULL THEN 1.0 / (r.distance_time + 60) END) AS weights, "
+            "    SUM(CASE WHEN h.latitude IS NOT NULL AND h.longitude IS NOT NULL THEN h.latitude / (r.distance_time + 60) END) AS latitudes, "
+            "    SUM(CASE WHEN h.latitude IS NOT NULL AND h.longitude IS NOT NULL THEN h.longitude / (r.distance_time + 60) END) AS longitudes "
+            "  SET s.closest_distance = closest, s.furthest_distance = furthest, "
+            "    s.hospital_count = hospitals, s.accessible_hospital_count = accessible_hospitals, "
+            "    s.total_beds = total_beds, "
+            "    s.latitude = CASE WHEN weights > 0 THEN latitudes / weights END, "
+            "    s.longitude = CASE WHEN weights > 0 THEN longitudes / weights END "
+            "} IN TRANSACTIONS OF 1000 ROWS"
+        )
+        self._run_write(query, ids=sa2_ids)
+
+    def _run_write(self, query: str, **parameters):
+        # Queries with CALL { } IN TRANSACTIONS have to run in an auto-commit transaction
+        with self.driver.session(database=self.database) as session:
+            session.run(query, **parameters).consume()
+        
+        if self.cache is not None:
+            self.cache.invalidate()
+
+    ### INCREMENTAL UPDATES
+    def upsert_sa2(self, rows, batch_size: int = 1000) -> dict:
+        return self._write_batches(self._merge_sa2_batch, rows, batch_size)
+
+    @staticmethod
+    def _merge_sa2_batch(tx, rows):
+        # Properties set to null are removed from the node
+        query = (
+            "UNWIND $rows AS row "
+            "MERGE (s:SA2 {id: row.id}) "
+            "SET s += row "
+        )
+        tx.run(query, rows=rows).consume()
+
+    def upsert_hospitals(self, rows, batch_size: int = 1000) -> dict:
+        return self._write_batches(self._merge_hospital_batch, rows, batch_size)
+
+    @staticmethod
+    def _merge_hospital_batch(tx, rows):
+        query = (
+            "UNWIND $rows AS row "
+            "MERGE (h:Hospital {id: row.id}) "
+            "SET h += row "
+        )
+        tx.run(query, rows=rows).consume()
+
+    def upsert_edges(self, rows, batch_size: int = 5000) -> dict:
+        return self._write_batches(self._merge_relation_sa2_hospital_batch, rows, batch_size)
+
+    @staticmethod
+    def _merge_relation_sa2_hospital_batch(tx, rows):
+        query = (
+            "UNWIND $rows AS row "
+            "MATCH (h:Hospital {id: row.hospital_id}), (s:SA2 {id: row.sa2_5dig}) "
+            "MERGE (h)-[r:REACHABLE_VIA]->(s) "
+            "SET r.distance_time = row.distance_time, r.accessible = row.accessible, r.further_than_2h = row.further_than_2h "
+        )
+        tx.run(query, rows=rows).consume()
+
+    def delete_sa2(self, ids, batch_size: int = 1000) -> dict:
+        return self._write_batches(self._delete_sa2_batch, ({"id": id} for id in ids), batch_size)
+
+    @staticmethod
+    def _delete_sa2_batch(tx, rows):
+        query = (
+            "UNWIND $rows AS row "
+            "MATCH (s:SA2 {id: row.id}) "
+            "DETACH DELETE s "
+        )
+        tx.run(query, rows=rows).consume()
+
+    def delete_hospitals(self, ids, batch_size: int = 1000) -> dict:
+        return self._write_batches(self._delete_hospital_batch, ({"id": id} for id in ids), batch_size)
+
+    @staticmethod
+    def _delete_hospital_batch(tx, rows):
+        query = (
+            "UNWIND $rows AS row "
+            "MATCH (h:Hospital {id: row.id}) "
+            "DETACH DELETE h "
+        )
+        tx.run(query, rows=rows).consume()
+
+    def delete_edges(self, pairs, batch_size: int = 5000) -> dict:
+        # pairs are (hospital_id, sa2_5dig) tuples
+        rows = ({"hospital_id": hospital_id, "sa2_5dig": sa2_5dig} for hospital_id, sa2_5dig in pairs)
+        return self._write_batches(self._delete_relation_sa2_hospital_batch, rows, batch_size)
+
+    @staticmethod
+    def _delete_relation_sa2_hospital_batch(tx, rows):
+        query = (
+            "UNWIND $rows AS row "
+            "MATCH (:Hospital {id: row.hospital_id})-[r:REACHABLE_VIA]->(:SA2 {id: row.sa2_5dig}) "
+            "DELETE r "
+        )
+        tx.run(query, rows=rows).consume()
+
+    def clear(self):
+        # Remove all nodes and their relationships, in small transactions so large graphs fit in memory
+        self._run_write(
+            "MATCH (n) "
+            "CALL { WITH n DETACH DELETE n } IN TRANSACTIONS OF 10000 ROWS"
+            )
+
+    def _write_batches(self, work, rows, batch_size: int) -> dict:
+        # Send the rows in chunks of batch_size, one managed write transaction per chunk
+        start = time.perf_counter()
+        rows = iter(rows)
+        total_rows = 0
+        total_batches = 0
+        with self.driver.session(database=self.database) as session:
+            while True:
+                batch = list(islice(rows, batch_size))
+                if not batch:
+                    break
+                session.execute_write(work, batch)
+                total_rows += len(batch)
+                total_batches += 1
+        seconds = time.perf_counter() - start
+        
+        # The graph changed, so cached results are stale
+        if self.cache is not None:
+            self.cache.invalidate()
+        
+        return {
+            "rows": total_rows,
+            "batches": total_batches,
+            "seconds": round(seconds, 3),
+            "rows_per_second": round(total_rows / seconds, 1) if seconds > 0 else None
+            }
+
+    @staticmethod
+    def _records(df):
+        # Yield the DataFrame rows as plain dictionaries, NaN values are stored as missing properties
+        for record in df.to_dict("records"):
+            yield {
+                key: None if isinstance(value, float) and math.isnan(value) else value
+                for key, value in record.items()
+                }
+
+    def run_query(
+        self, query: str, query_limit: int, example_key: str, on_chunk=None,
+        timeout: float | None = None, metadata: dict | None = None, trace=None, profile: bool = False,
+        parameters: dict | None = None
+        ) -> list | Exception:
+        # A profiled run is never served from the cache, its plan and db hits are what was asked for
+        cache_key = QueryCache.make_key(query, query_limit, example_key, *self._parameters_key(parameters))
+        if self.cache is not None and not profile:
+            found, graph = self.cache.get(cache_key)
+            if trace is not None:
+                trace.add_stage("cache", 0, hit=found)
+            if found:
+                return graph
+        
+        graph = []
+        summaries = []
+        for chunk in self.stream_query(
+            query, query_limit, example_key, timeout=timeout, metadata=metadata, trace=trace, profile=profile,
+            parameters=parameters, on_summary=summaries.append
+            ):
+            graph.extend(chunk)
+            # Let the caller render the first rows while the rest is still arriving
+            if on_chunk is not None:
+                on_chunk(graph)
+        
+        # Results of a CREATE, SET or DELETE are not cached, running it again has to write again
+        if self.cache is not None and not any(summary.counters.contains_updates for summary in summaries):
+            self.cache.put(cache_key, graph)
+        return graph
+
+    def run_query_frame(
+        self, query: str, query_limit: int | None, example_key: str = "", on_chunk=None,
+        timeout: float | None = None, metadata: dict | None = None, trace=None, profile: bool = False,
+        parameters: dict | None = None
+        ) -> dict | pd.DataFrame:
+        # Same as run_query, but the chunks are converted to frames as they arrive: one typed frame per
+        # node label deduplicated by id and one for the edges (see to_frames), or one table for TABULAR_QUERIES
+        cache_key = QueryCache.make_key(query, query_limit, example_key, "frame", *self._parameters_key(parameters))
+        if self.cache is not None and not profile:
+            found, frames = self.cache.get(cache_key)
+            if trace is not None:
+                trace.add_stage("cache", 0, hit=found)
+            if found:
+                return frames
+        
+        summaries = []
+        chunks = self.stream_query(
+            query, query_limit, example_key, timeout=timeout, metadata=metadata, trace=trace, profile=profile,
+            parameters=parameters, on_summary=summaries.append
+            )
+        frames = self.result_frames(chunks if on_chunk is None else self._observe(chunks, on_chunk), example_key)
+        
+        if self.cache is not None and not any(summary.counters.contains_updates for summary in summaries):
+            self.cache.put(cache_key, frames)
+        return frames
+
+    @staticmethod
+    def _observe(chunks, on_chunk):
+        # Pass every chunk to the caller before it is converted, e.g. to show the progress
+        for chunk in chunks:
+            on_chunk(chunk)
+            yield chunk
+
+    def submit_query(
+        self, query: str, query_limit: int, example_key: str, timeout: float | None = None,
+        trace=None, profile: bool = False, parameters: dict | None = None
+        ) -> QueryJob:
+        # Run the query on a background thread, the returned job can be polled and cancelled
+        return QueryJob(self, query, query_limit, example_key, timeout, trace=trace, profile=profile, parameters=parameters)
+
+    @staticmethod
+    def _parameters_key(parameters: dict | None) -> tuple:
+        # Query parameters as part of a cache key, the page keys are strings or lists of strings
+        if parameters is None:
+            return ()
+        return tuple(sorted(
+            (name, tuple(value) if isinstance(value, list) else value) for name, value in parameters.items()
+            ))
+
+    def terminate_transactions(self, job_id: str) -> int:
+        # Terminate the server side transactions started by a QueryJob
+        with self.driver.session(database=self.database) as session:
+            transaction_ids = [
+                record["transactionId"] for record in session.run(
+                    "SHOW TRANSACTIONS YIELD transactionId, metaData "
+                    "WHERE metaData.job_id = $job_id "
+                    "RETURN transactionId",
+                    job_id=job_id
+                    )
+                ]
+            if len(transaction_ids) > 0:
+                session.run("TERMINATE TRANSACTIONS $ids", ids=transaction_ids).consume()
+        return len(transaction_ids)
+
+    def stream_query(
+        self, query: str, query_limit: int | None = None, example_key: str = "", fetch_size: int = 250,
+        timeout: float | None = None, metadata: dict | None = None, trace=None, profile: bool = False,
+        parameters: dict | None = None, on_summary=None
+        ):
+        # Yield the result in chunks of fetch_size rows as they arrive from the database,
+        # the server aborts the transaction when it runs longer than timeout seconds.
+        # on_summary gets the result summary once the whole result is read
+        if query_limit is not None:
             query = f"{query} LIMIT {query_limit}"
-            result = session.run(query)
+        if profile:
+            query = f"PROFILE {query}"
+        
+        # Time spent converting records and in the caller between chunks is kept apart,
+        # what remains of the wall time is spent waiting on the database
+        start = time.perf_counter()
+        conversion = 0.0
+        consumer = 0.0
+        
+        # Nodes and relationships are converted to plain property dictionaries once,
+        # rows referring to the same node share the same dictionary
+        interned = {}
+        with self.driver.session(database=self.database, fetch_size=fetch_size) as session:
+            result = session.run(Query(query, metadata=metadata, timeout=timeout), parameters or {})
+            chunk = []
+            for record in result:
+                convert_start = time.perf_counter()
+                # The example queries returning a table are kept as they are,
+                # else we store the result as hospital, sa2, relation
+                if example_key in TABULAR_QUERIES:
+                    chunk.append(record.data())
+                else:
+                    chunk.append(self._graph_row(record, interned))
+                conversion += time.perf_counter() - convert_start
+                
+                if len(chunk) >= fetch_size:
+                    yield_start = time.perf_counter()
+                    yield chunk
+                    consumer += time.perf_counter() - yield_start
+                    chunk = []
+            if chunk:
+                yield_start = time.perf_counter()
+                yield chunk
+                consumer += time.perf_counter() - yield_start
             
-            # If the query is one of the example queries, we need to convert the result to a dictionary
-            if st.session_state.example_key in [
-                "most_accessible",
-                "population_to_beds",
-                "least_hospitals",
-                "distance_ratio"
-            ]:
-                for record in result:
-                    # Convert record to proper dictionary
-                    record_dict = {}
-                    for key in record.keys():
-                        record_dict[key] = record[key]
-                    
-                    graph.append(record_dict)
+            summary = result.consume()
+            if trace is not None:
+                trace.add_stage("database", time.perf_counter() - start - conversion - consumer)
+                trace.add_stage("conversion", conversion)
+                trace.add_query(query, summary, example_key=example_key)
+            
+            # A query that wrote to the graph makes every cached result stale
+            if summary.counters.contains_updates and self.cache is not None:
+                self.cache.invalidate()
+            if on_summary is not None:
+                on_summary(summary)
+
+    ### AGGREGATES
+    def distance_stats_by_hospital(self) -> pd.DataFrame:
+        # Statistics of the REACHABLE_VIA edges per hospital, computed by the database over the full graph
+        query = (
+            "MATCH (h:Hospital)-[r:REACHABLE_VIA]->(s:SA2) "
+            "RETURN h.id AS hospital_id, h.hospital_name AS hospital_name, "
+            "COUNT(s) AS sa2_count, "
+            "AVG(r.distance_time) AS mean_distance, "
+            "MIN(r.distance_time) AS min_distance, "
+            "MAX(r.distance_time) AS max_distance, "
+            "AVG(CASE WHEN r.accessible THEN 100.0 ELSE 0.0 END) AS accessible_percentage, "
+            "AVG(CASE WHEN r.further_than_2h THEN 100.0 ELSE 0.0 END) AS further_than_2h_percentage "
+            "ORDER BY hospital_name"
+        )
+        return self._run_aggregate(query)
+
+    def distance_stats_by_sa2(self) -> pd.DataFrame:
+        # Statistics of the REACHABLE_VIA edges per SA2, computed by the database over the full graph
+        query = (
+            "MATCH (h:Hospital)-[r:REACHABLE_VIA]->(s:SA2) "
+            "RETURN s.id AS sa2_id, s.sa2_name AS sa2_name, "
+            "COUNT(h) AS hospital_count, "
+            "AVG(r.distance_time) AS mean_distance, "
+            "MIN(r.distance_time) AS min_distance, "
+            "MAX(r.distance_time) AS max_distance, "
+            "AVG(CASE WHEN r.accessible THEN 100.0 ELSE 0.0 END) AS accessible_percentage, "
+            "AVG(CASE WHEN r.further_than_2h THEN 100.0 ELSE 0.0 END) AS further_than_2h_percentage "
+            "ORDER BY sa2_name"
+        )
+        return self._run_aggregate(query)
+
+    def _run_aggregate(self, query: str) -> pd.DataFrame:
+        cache_key = QueryCache.make_key(query, None, "aggregate")
+        if self.cache is not None:
+            found, frame = self.cache.get(cache_key)
+            if found:
+                return frame
+        
+        with self.driver.session(database=self.database) as session:
+            frame = pd.DataFrame([record.data() for record in session.run(query)])
+        
+        if self.cache is not None:
+            self.cache.put(cache_key, frame)
+        return frame
+
+    @classmethod
+    def result_frames(cls, chunks, example_key: str = "") -> dict | pd.DataFrame:
+        # Chunks of rows as returned by stream_query (or AnalyticsEngine.run_query) to frames
+        if example_key in TABULAR_QUERIES:
+            tables = [pd.DataFrame(chunk) for chunk in chunks]
+            return pd.concat(tables, ignore_index=True) if len(tables) > 0 else pd.DataFrame()
+        return cls.to_frames(row for chunk in chunks for row in chunk)
+
+    @staticmethod
+    def to_frames(rows) -> dict:
+        # Nodes are deduplicated by id while the rows come in and the edges are kept as compact columns
+        # of node positions, travel times and flags, so no list of rows is built up. The number of rows
+        # and the page key of the last row are kept so the frames of a page tell where the next page starts
+        hospitals = {}
+        sa2s = {}
+        row_count = 0
+        page_key = None
+        edge_hospitals = array("q")
+        edge_sa2s = array("q")
+        edge_distances = array("d")
+        edge_accessible = array("b")
+        edge_further = array("b")
+        for row in rows:
+            row_count += 1
+            page_key = row.get(PAGE_KEY)
+            hospital, sa2, relation = row["hospital"], row["sa2"], row["relation"]
+            if hospital is not None:
+                hospital_position = hospitals.setdefault(hospital.get("id"), (len(hospitals), hospital))[0]
+            if sa2 is not None:
+                sa2_position = sa2s.setdefault(sa2.get("id"), (len(sa2s), sa2))[0]
+            if relation is not None and hospital is not None and sa2 is not None:
+                edge_hospitals.append(hospital_position)
+                edge_sa2s.append(sa2_position)
+                distance_time = relation.get("distance_time")
+                edge_distances.append(float(distance_time) if distance_time is not None else math.nan)
+                edge_accessible.append(bool(relation.get("accessible")))
+                edge_further.append(bool(relation.get("further_than_2h")))
+        
+        hospital_ids = np.array(list(hospitals), dtype=object)
+        sa2_ids = np.array(list(sa2s), dtype=object)
+        return {
+            "Hospital": pd.DataFrame([hospital for _, hospital in hospitals.values()]),
+            "SA2": pd.DataFrame([sa2 for _, sa2 in sa2s.values()]),
+            "edges": pd.DataFrame({
+                "hospital_id": pd.Series(hospital_ids.take(np.frombuffer(edge_hospitals, dtype=np.int64)), dtype="object"),
+                "sa2_id": pd.Series(sa2_ids.take(np.frombuffer(edge_sa2s, dtype=np.int64)), dtype="object"),
+                "distance_time": pd.Series(np.frombuffer(edge_distances, dtype=np.float64), dtype="float64"),
+                "accessible": pd.Series(np.frombuffer(edge_accessible, dtype=np.int8).astype(bool), dtype="bool"),
+                "further_than_2h": pd.Series(np.frombuffer(edge_further, dtype=np.int8).astype(bool), dtype="bool")
+                }),
+            "row_count": row_count,
+            PAGE_KEY: page_key
+            }
+
+    @classmethod
+    def concat_frames(cls, pages: list) -> dict:
+        # The frames of several pages as one, nodes shared by the pages are kept once
+        if len(pages) == 0:
+            return cls.to_frames([])
+        if len(pages) == 1:
+            return pages[0]
+        
+        def unique_nodes(label: str) -> pd.DataFrame:
+            nodes = pd.concat([page[label] for page in pages], ignore_index=True)
+            return nodes.drop_duplicates("id", ignore_index=True) if "id" in nodes.columns else nodes
+        
+        return {
+            "Hospital": unique_nodes("Hospital"),
+            "SA2": unique_nodes("SA2"),
+            "edges": pd.concat([page["edges"] for page in pages], ignore_index=True),
+            "row_count": sum(page["row_count"] for page in pages),
+            PAGE_KEY: pages[-1][PAGE_KEY]
+            }
+
+    @staticmethod
+    def _graph_row(record, interned: dict) -> dict:
+        row = {"hospital": None, "sa2": None, "relation": None}
+        for name, value in record.items():
+            if name == PAGE_KEY:
+                row[PAGE_KEY] = value
+                continue
+            if isinstance(value, Relationship):
+                key = "relation"
+            elif isinstance(value, Node):
+                key = "hospital" if "Hospital" in value.labels else "sa2"
             else:
-                # Else we can just append the result to the graph list as hostpital, sa2, relation
-                for record in result:
-                    if record[0].labels == {"Hospital"}:
-                        graph.append(
-                            {
-                                "hospital": record[0], 
-                                "sa2": record[2], 
-                                "relation": record[1]
-                            })
-                    else:
-                        graph.append(
-                            {
-                                "hospital": record[2], 
-                                "sa2": record[0], 
-                                "relation": record[1]
-                            })
+                continue
+            
+            if value.element_id not in interned:
+                interned[value.element_id] = dict(value)
+            row[key] = interned[value.element_id]
+        return row
+        
+    def fetch_data(self, limit, trace=None):
+        cache_key = QueryCache.make_key("fetch_data", limit)
+        if self.cache is not None:
+            found, graph = self.cache.get(cache_key)
+            if trace is not None:
+                trace.add_stage("cache", 0, hit=found)
+            if found:
+                return graph
+        
+        query = f"""
+        OPTIONAL MATCH (n)-[r]->(m)
+        RETURN n, r, m
+        """
+        graph = [row for chunk in self.stream_query(query, limit, trace=trace) for row in chunk]
+        
+        if self.cache is not None:
+            self.cache.put(cache_key, graph)
         return graph
 
+    ### PAGING
+    def fetch_page(self, after: str | None = None, page_size: int = 1000, trace=None) -> dict:
+        # One page of page_size hospitals in id order with all their edges to SA2s, continuing after the id
+        # of the last hospital of the previous page instead of skipping rows. The hospitals are read from
+        # the id constraint index in its order, so a page costs its own hospitals and edges and not the
+        # whole graph. A hospital without edges still gives one row, so a full page has page_size rows or more
+        cache_key = QueryCache.make_key("fetch_page", page_size, *self._parameters_key({"after": after}))
+        if self.cache is not None:
+            found, frames = self.cache.get(cache_key)
+            if trace is not None:
+                trace.add_stage("cache", 0, hit=found)
+            if found:
+                return frames
         
-    def fetch_data(self, limit):
-        with self.driver.session(database=self.database) as session:     
-            graph = []  
-            query = f"""
-            OPTIONAL MATCH (n)-[r]->(m)
-            RETURN n, r, m
-            LIMIT {limit}
-            """
-            result = session.run(query)
-            for record in result:
-                if record[0].labels == {"Hospital"}:
-                    graph.append(
-                        {
-                            "hospital": record[0], 
-                            "sa2": record[2], 
-                            "relation": record[1]
-                        })
-                else:
-                    graph.append(
-                        {
-                            "hospital": record[2], 
-                            "sa2": record[0], 
-                            "relation": record[1]
-                        })
-        return graph
\ No newline at end of file
+        # The predicate on h.id lets the planner seek the index and take its order instead of sorting
+        continuation = "h.id IS NOT NULL" if after is None else "h.id > $after"
+        query = (
+            f"MATCH (h:Hospital) WHERE {continuation} "
+            "WITH h ORDER BY h.id LIMIT $page_size "
+            "OPTIONAL MATCH (h)-[r:REACHABLE_VIA]->(s:SA2) "
+            f"RETURN h, r, s, h.id AS {PAGE_KEY} "
+            # Only the rows of the page are sorted, the last row has to carry the last hospital id
+            f"ORDER BY {PAGE_KEY}"
+        )
+        frames = self.result_frames(
+            self.stream_query(query, trace=trace, parameters={"after": after, "page_size": page_size})
+            )
+        
+        if self.cache is not None:
+            self.cache.put(cache_key, frames)
+        return frames
+
+    @staticmethod
+    def paged_query(query: str) -> str | None:
+        # Page a plain MATCH ... RETURN over one directed, named relationship on the element id of that
+        # relationship, None for any other query so it runs with a LIMIT instead. The filter and the
+        # ORDER BY with LIMIT are added to the query itself, so the server keeps only the top page_size
+        # rows instead of returning the whole result. No index covers elementId, so every page still
+        # matches all the relationships of the query: a page costs O(E) with a top page_size sort
+        query = query.strip().rstrip(";").strip()
+        matched = PLAIN_MATCH.match(query)
+        if matched is None or NOT_PAGEABLE.search(query) is not None:
+            return None
+        
+        variable = matched.group("relationship") or matched.group("outgoing")
+        items = [item.strip() for item in matched.group("items").split(",")]
+        if variable not in items or not all(re.fullmatch(r"[A-Za-z_]\w*", item) for item in items):
+            return None
+        
+        return (
+            f"{matched.group('match')} "
+            f"WITH * WHERE $after IS NULL OR elementId({variable}) > $after "
+            f"RETURN {', '.join(items)}, elementId({variable}) AS {PAGE_KEY} "
+            f"ORDER BY {PAGE_KEY} "
+            "LIMIT $page_size"
+        )
+
+    def query_page(
+        self, paged_query: str, after: str | None, page_size: int, trace=None,
+        example_key: str = "", timeout: float | None = None
+        ) -> dict:
+        # One page of a query wrapped by paged_query as frames, every page is cached on its own
+        return self.run_query_frame(
+            paged_query, None, example_key, timeout=timeout, trace=trace,
+            parameters={"after": after, "page_size": page_size}
+            )
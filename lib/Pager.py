@@ -0,0 +1,46 @@
+import time
+
+from lib.GraphDB import GraphDB, PAGE_KEY
+from lib.QueryJob import QueryJob
+
+class Pager:
+    # Keyset pagination of a query that returns a page_key column. The loaded pages are kept, and the
+    # next page is fetched on the query thread pool while the loaded ones are being looked at
+    def __init__(self, fetch, page_size: int, prefetch: bool = True):
+        # fetch(after, page_size, trace) returns the frames (see GraphDB.to_frames) of the rows
+        # after the given key, the first page has key None
+        self.fetch = fetch
+        self.page_size = page_size
+        self.prefetch = prefetch
+        self.pages = []
+        self.next_key = None
+        self.complete = False
+        self._future = None
+
+    def add_page(self, frames: dict):
+        # A short page, or rows without a key, is the last page
+        self.pages.append(frames)
+        self.next_key = frames[PAGE_KEY] if frames["row_count"] >= self.page_size > 0 else None
+        self.complete = self.next_key is None
+        if self.prefetch and not self.complete:
+            self._future = QueryJob.executor().submit(self.fetch, self.next_key, self.page_size, None)
+
+    def load_next(self, trace=None) -> dict:
+        # The prefetched page if there is one, a failed prefetch is raised here and fetched again on the next call
+        if self.complete:
+            return GraphDB.to_frames([])
+        future, self._future = self._future, None
+        prefetched = future is not None and future.done()
+        start = time.perf_counter()
+        frames = future.result() if future is not None else self.fetch(self.next_key, self.page_size, trace)
+        if trace is not None:
+            trace.add_stage("page", time.perf_counter() - start, page=len(self.pages) + 1, prefetched=prefetched)
+        self.add_page(frames)
+        return frames
+
+    def frames(self) -> dict:
+        # All loaded pages as one set of frames
+        return GraphDB.concat_frames(self.pages)
+
+    def row_count(self) -> int:
+        return sum(page["row_count"] for page in self.pages)
@@ -0,0 +1,205 @@
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import os
+import random
+import threading
+import time
+
+from neo4j.exceptions import DriverError, Neo4jError
+import pandas as pd
+import yaml
+from yaml.loader import SafeLoader
+
+from lib.GraphDB import GraphDB
+from lib.TravelTimeStore import TravelTimeStore
+from lib import Pipeline
+
+class ParallelLoader:
+    # Loads the REACHABLE_VIA edges from several sessions at once. The edges are split into a grid of
+    # SA2 groups x hospital groups, and every round gives each worker one cell so that no two workers
+    # touch the same SA2 or hospital: worker i writes cell (i, (i + round) % workers). Creating a
+    # relationship locks both of its nodes, so partitioning on the SA2s alone would still have the
+    # workers wait on (and deadlock over) the shared hospitals
+    def __init__(
+        self, graph_db: GraphDB, workers: int = 4, batch_size: int = 5000,
+        max_retries: int = 8, backoff_seconds: float = 0.1, max_backoff_seconds: float = 5.0
+        ):
+        self.graph_db = graph_db
+        self.workers = max(1, workers)
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self, total_rows: int | None = None, on_progress=None):
+        self.total_rows = total_rows
+        self.on_progress = on_progress
+        self.rows = 0
+        self.batches = 0
+        self.retries = 0
+        self.rounds = 0
+        self.start = time.perf_counter()
+
+    ### LOADING
+    def load(self, sa2: pd.DataFrame, hospitals: pd.DataFrame, edges, total_rows: int | None = None, on_progress=None) -> dict:
+        # Nodes first, the edges MATCH on them
+        return {
+            "sa2": self.graph_db.bulk_load_sa2(sa2),
+            "hospitals": self.graph_db.bulk_load_hospitals(hospitals),
+            "edges": self.load_edges(edges, total_rows, on_progress)
+            }
+
+    def load_edges(self, edges, total_rows: int | None = None, on_progress=None) -> dict:
+        # edges is a DataFrame in the layout of GraphDB.bulk_load_edges or an iterable of them, every
+        # chunk is written completely before the next one is read. on_progress gets the report after every batch
+        if isinstance(edges, pd.DataFrame):
+            total_rows = len(edges) if total_rows is None else total_rows
+            edges = [edges]
+        self._reset(total_rows, on_progress)
+
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="ingest") as executor:
+            for chunk in edges:
+                cells = self.partition(chunk)
+                for round_number in range(self.workers):
+                    # The cells of a round share no nodes, the next round waits until they are written
+                    futures = [
+                        executor.submit(self._write_cell, cells.get((group, (group + round_number) % self.workers)))
+                        for group in range(self.workers)
+                        ]
+                    for future in futures:
+                        future.result()
+                    self.rounds += 1
+
+        # Like bulk_load_edges, the summaries and the cached results depend on the edges
+        self.graph_db.materialize_accessibility()
+        return self.report()
+
+    def partition(self, edges: pd.DataFrame) -> dict:
+        # The edges of every (SA2 group, hospital group) cell, sorted by hospital and SA2 so
+        # the batches of a cell take their locks in the same order
+        sa2_ids = edges["SA2_5DIG"].astype(str)
+        hospital_ids = edges["hospital_ID"].astype(str)
+        sa2_groups = pd.util.hash_array(sa2_ids.to_numpy(dtype=object)) % self.workers
+        hospital_groups = pd.util.hash_array(hospital_ids.to_numpy(dtype=object)) % self.workers
+
+        ordered = edges.assign(
+            _sa2_group=sa2_groups, _hospital_group=hospital_groups, _hospital=hospital_ids, _sa2=sa2_ids
+            ).sort_values(["_hospital", "_sa2"], kind="stable")
+        return {
+            (int(sa2_group), int(hospital_group)): cell.drop(columns=["_sa2_group", "_hospital_group", "_hospital", "_sa2"])
+            for (sa2_group, hospital_group), cell in ordered.groupby(["_sa2_group", "_hospital_group"], sort=False)
+            }
+
+    def _write_cell(self, cell: pd.DataFrame | None):
+        if cell is None or len(cell) == 0:
+            return
+        rows = list(GraphDB.edge_rows(cell))
+        with self.graph_db.driver.session(database=self.graph_db.database) as session:
+            for start in range(0, len(rows), self.batch_size):
+                batch = rows[start:start + self.batch_size]
+                retries = self._write_batch(session, batch)
+                self._progress(len(batch), retries)
+
+    def _write_batch(self, session, rows: list) -> int:
+        # Retry deadlocks and other transient errors with exponential backoff and jitter, returns the number of retries
+        for attempt in range(self.max_retries + 1):
+            try:
+                with session.begin_transaction() as tx:
+                    GraphDB._merge_relation_sa2_hospital_batch(tx, rows)
+                    tx.commit()
+                return attempt
+            except (Neo4jError, DriverError) as e:
+                if attempt == self.max_retries or not e.is_retryable():
+                    raise
+                delay = min(self.max_backoff_seconds, self.backoff_seconds * 2 ** attempt)
+                time.sleep(delay * random.uniform(0.5, 1.5))
+
+    ### PROGRESS
+    def _progress(self, rows: int, retries: int):
+        with self._lock:
+            self.rows += rows
+            self.batches += 1
+            self.retries += retries
+            report = self.report()
+        if self.on_progress is not None:
+            self.on_progress(report)
+
+    def report(self) -> dict:
+        seconds = time.perf_counter() - self.start
+        return {
+            "rows": self.rows,
+            "total_rows": self.total_rows,
+            "batches": self.batches,
+            "retries": self.retries,
+            "rounds": self.rounds,
+            "workers": self.workers,
+            "seconds": round(seconds, 3),
+            "rows_per_second": round(self.rows / seconds, 1) if seconds > 0 else None
+            }
+
+def store_edges(store: TravelTimeStore, chunk_sa2: int = 10000):
+    # Every stored SA2 x hospital travel time as edges, in chunks of SA2 regions
+    for start in range(0, len(store.sa2_ids), chunk_sa2):
+        sa2_ids, hospital_ids, durations = store.edges(start, start + chunk_sa2)
+        yield pd.DataFrame({
+            "SA2_5DIG": sa2_ids,
+            "hospital_ID": hospital_ids,
+            "distance_time": durations,
+            "accessible": durations < Pipeline.ACCESSIBLE_SECONDS,
+            "further_than_2h": durations > Pipeline.FAR_SECONDS
+            })
+
+def main():
+    parser = argparse.ArgumentParser(description="Load the knowledge graph with several parallel sessions")
+    parser.add_argument("--config", default="config.yaml", help="Configuration file with the database settings")
+    parser.add_argument("--datadir", default="data/processed", help="Directory with the processed csv files")
+    parser.add_argument("--store", default=None, help="Load every travel time of this TravelTimeStore instead of the closest hospitals")
+    parser.add_argument("--workers", type=int, default=4, help="Parallel sessions writing edges")
+    parser.add_argument("--batch-size", type=int, default=5000, help="Edges per transaction")
+    parser.add_argument("--clear", action="store_true", help="Delete the whole graph before loading")
+    args = parser.parse_args()
+
+    with open(args.config) as config_file:
+        config = yaml.load(config_file, Loader=SafeLoader)
+    graph_db = GraphDB(
+        uri=config["DATABASE"]["URI"],
+        user=config["DATABASE"]["USER"],
+        password=config["DATABASE"]["PASSWORD"],
+        database=config["DATABASE"]["DBNAME"]
+        )
+
+    if args.store is not None:
+        store = TravelTimeStore(args.store)
+        edges, total_rows = store_edges(store), store.meta["entries"]
+    else:
+        edges = Pipeline.edge_list(pd.read_csv(os.path.join(args.datadir, "HospitalDistance.csv")))
+        total_rows = len(edges)
+
+    def show(report: dict):
+        done = f"{report['rows']}/{report['total_rows']}" if report["total_rows"] else str(report["rows"])
+        print(f"\r{done} edges, {report['rows_per_second']} edges/s, {report['retries']} retries", end="", flush=True)
+
+    try:
+        if args.clear:
+            graph_db.clear()
+        graph_db.ensure_schema()
+        for error in graph_db.schema_errors:
+            print(f"Schema not created: {error}")
+        loader = ParallelLoader(graph_db, args.workers, args.batch_size)
+        report = loader.load(
+            pd.read_csv(os.path.join(args.datadir, "SA2PopulationData.csv")),
+            pd.read_csv(os.path.join(args.datadir, "HospitalMetadata.csv")),
+            edges, total_rows, on_progress=show
+            )
+    finally:
+        graph_db.close()
+
+    print()
+    for name, stage in report.items():
+        print(f"{name}: {stage['rows']} rows in {stage['seconds']} s ({stage['rows_per_second']} rows/s)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+import argparse
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from lib.TravelTimeStore import TravelTimeStore
+
+# Travel time thresholds in seconds
+ACCESSIBLE_SECONDS = 1800
+FAR_SECONDS = 7200
+
+def distance_matrix(data_distance_all: pd.DataFrame) -> tuple:
+    # Split the wide duration table into the SA2 codes, the hospital ids and a SA2 x hospital matrix
+    hospital_columns = [column for column in data_distance_all.columns if column != "SA2_5DIG16"]
+    sa2_ids = data_distance_all["SA2_5DIG16"].to_numpy(dtype=np.int64)
+    hospital_ids = np.array([int(column.split("_")[2]) for column in hospital_columns], dtype=np.int64)
+    durations = data_distance_all[hospital_columns].to_numpy(dtype=np.float64)
+    return sa2_ids, hospital_ids, durations
+
+def accessibility_edges(sa2_ids: np.ndarray, hospital_ids: np.ndarray, durations: np.ndarray) -> pd.DataFrame:
+    # One row per SA2 and hospital pair, missing durations are neither accessible nor too far
+    with np.errstate(invalid="ignore"):
+        accessible = durations < ACCESSIBLE_SECONDS
+        further_than_2h = durations > FAR_SECONDS
+
+    return pd.DataFrame({
+        "SA2_5DIG": np.repeat(sa2_ids, len(hospital_ids)),
+        "hospital_ID": np.tile(hospital_ids, len(sa2_ids)),
+        "accessible": accessible.ravel(),
+        "further_than_2h": further_than_2h.ravel()
+        })
+
+def closest_hospitals(sa2_ids: np.ndarray, hospital_ids: np.ndarray, durations: np.ndarray, k: int = 5) -> pd.DataFrame:
+    # The k nearest hospitals of every SA2 as ";" separated ids and durations, sorted by duration
+    k = min(k, durations.shape[1])
+    filled = np.where(np.isnan(durations), np.inf, durations)
+
+    # Select the k smallest durations per row without sorting the whole row, then sort only those
+    nearest = np.argpartition(filled, k - 1, axis=1)[:, :k]
+    nearest_durations = np.take_along_axis(filled, nearest, axis=1)
+    order = np.argsort(nearest_durations, axis=1)
+    nearest = np.take_along_axis(nearest, order, axis=1)
+    nearest_durations = np.take_along_axis(nearest_durations, order, axis=1)
+    found = np.isfinite(nearest_durations).sum(axis=1)
+    return closest_frame(sa2_ids, hospital_ids[nearest], nearest_durations, found)
+
+def closest_hospitals_from_store(store: TravelTimeStore, k: int = 5) -> pd.DataFrame:
+    # Same as closest_hospitals, but only reads the first k entries of every SA2 from the store
+    nearest_ids, nearest_durations, found = store.nearest_all(k)
+    return closest_frame(store.sa2_ids, nearest_ids, nearest_durations, found)
+
+def closest_frame(sa2_ids: np.ndarray, nearest_ids: np.ndarray, nearest_durations: np.ndarray, found: np.ndarray) -> pd.DataFrame:
+    # Join the first found ids and durations of every row with ";"
+    closest_ids = []
+    closest_distances = []
+    for row in range(len(sa2_ids)):
+        if found[row] == 0:
+            closest_ids.append("Not found")
+            closest_distances.append("Not found")
+            continue
+        closest_ids.append(";".join(str(hospital_id) for hospital_id in nearest_ids[row, :found[row]]))
+        closest_distances.append(";".join(str(float(duration)) for duration in nearest_durations[row, :found[row]]))
+
+    return pd.DataFrame({
+        "SA2_5DIG": sa2_ids,
+        "closest_hospital_IDs": closest_ids,
+        "closest_hospital_distances": closest_distances
+        })
+
+def hospital_distance(data_distance_shortest: pd.DataFrame, closest: pd.DataFrame) -> pd.DataFrame:
+    # Combine the shortest travel time per SA2 with its closest hospitals
+    shortest = data_distance_shortest.drop(columns=["shortest_time_min"], errors="ignore").rename(
+        columns={"SA2_5DIG16": "SA2_5DIG"}
+        )
+    return shortest.merge(closest, on="SA2_5DIG", how="left").fillna("Not found")
+
+def edge_list(hospital_distance: pd.DataFrame, accessibility: pd.DataFrame | None = None) -> pd.DataFrame:
+    # One row per SA2 and closest hospital with the accessibility flags, as used by GraphDB.bulk_load_edges,
+    # without the accessibility edges the flags are derived from the travel times
+    edges = hospital_distance[hospital_distance["closest_hospital_IDs"] != "Not found"].copy()
+    edges["hospital_ID"] = edges["closest_hospital_IDs"].str.split(";")
+    edges["distance_time"] = edges["closest_hospital_distances"].str.split(";")
+    edges = edges.explode(["hospital_ID", "distance_time"])
+    edges["hospital_ID"] = edges["hospital_ID"].astype(np.int64)
+    edges["distance_time"] = edges["distance_time"].astype(np.float64)
+    edges["SA2_5DIG"] = edges["SA2_5DIG"].astype(np.int64)
+    if accessibility is None:
+        edges["accessible"] = edges["distance_time"] < ACCESSIBLE_SECONDS
+        edges["further_than_2h"] = edges["distance_time"] > FAR_SECONDS
+        return edges
+    return edges.merge(accessibility, on=["SA2_5DIG", "hospital_ID"], how="inner")
+
+def run(datadir: str, savedir: str, k: int = 5, store: str | None = None) -> dict:
+    if store is not None:
+        return run_store(store, savedir, k)
+    timings = {}
+
+    start = time.perf_counter()
+    data_distance_all = pd.read_pickle(os.path.join(datadir, "duration_sa2_hospitals.pkl"))
+    data_distance_shortest = pd.read_pickle(os.path.join(datadir, "duration_sa2_hospital_shortest.pkl"))
+    timings["load"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    sa2_ids, hospital_ids, durations = distance_matrix(data_distance_all)
+    accessibility = accessibility_edges(sa2_ids, hospital_ids, durations)
+    closest = closest_hospitals(sa2_ids, hospital_ids, durations, k)
+    distances = hospital_distance(data_distance_shortest, closest)
+    timings["compute"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    accessibility.to_csv(os.path.join(savedir, "AccessibilityEdges.csv"), index=False)
+    distances.to_csv(os.path.join(savedir, "HospitalDistance.csv"), index=False)
+    timings["save"] = time.perf_counter() - start
+
+    return timings
+
+def run_store(path: str, savedir: str, k: int = 5, chunk_rows: int = 1000) -> dict:
+    # Like run, but reads the travel times from a TravelTimeStore instead of unpickling the whole table
+    timings = {}
+
+    start = time.perf_counter()
+    store = TravelTimeStore(path)
+    timings["load"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    closest = closest_hospitals_from_store(store, k)
+    shortest = pd.DataFrame({"SA2_5DIG16": store.sa2_ids, "shortest_time_sec": store.shortest()})
+    distances = hospital_distance(shortest, closest)
+    timings["compute"] = time.perf_counter() - start
+
+    # The accessibility edges are written per chunk of SA2s, only the stored pairs are included
+    start = time.perf_counter()
+    for chunk_start in range(0, len(store.sa2_ids), chunk_rows):
+        sa2_ids, hospital_ids, durations = store.edges(chunk_start, chunk_start + chunk_rows)
+        pd.DataFrame({
+            "SA2_5DIG": sa2_ids,
+            "hospital_ID": hospital_ids,
+            "accessible": durations < ACCESSIBLE_SECONDS,
+            "further_than_2h": durations > FAR_SECONDS
+            }).to_csv(
+            os.path.join(savedir, "AccessibilityEdges.csv"),
+            mode="w" if chunk_start == 0 else "a",
+            header=chunk_start == 0,
+            index=False
+            )
+    distances.to_csv(os.path.join(savedir, "HospitalDistance.csv"), index=False)
+    timings["save"] = time.perf_counter() - start
+
+    return timings
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the accessibility edges and closest hospitals of every SA2")
+    parser.add_argument("--datadir", default="data/original", help="Directory with the raw duration pickles")
+    parser.add_argument("--savedir", default="data/processed", help="Directory to write the csv files to")
+    parser.add_argument("--top-k", type=int, default=5, help="Number of closest hospitals to keep per SA2")
+    parser.add_argument("--store", default=None, help="Travel time store to read instead of the pickles, see lib.TravelTimeStore")
+    args = parser.parse_args()
+
+    timings = run(args.datadir, args.savedir, args.top_k, args.store)
+    for stage, seconds in timings.items():
+        print(f"{stage}: {seconds:.3f}s")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+from collections import OrderedDict
+import re
+import sys
+import threading
+import time
+
+# Quoted strings are kept as they are when normalizing the query text
+QUOTED = re.compile(r"""('(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*"|`[^`]*`)""")
+WHITESPACE = re.compile(r"\s+")
+
+class QueryCache:
+    def __init__(self, max_entries: int = 128, ttl_seconds: float = 600, max_bytes: int = 256 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+
+        # key -> (expiry time, estimated size, value), ordered from least to most recently used
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def normalize(query: str) -> str:
+        # Collapse whitespace outside of string literals and drop a trailing semicolon
+        parts = QUOTED.split(query.strip().rstrip(";").strip())
+        return "".join(
+            part if index % 2 else WHITESPACE.sub(" ", part)
+            for index, part in enumerate(parts)
+            )
+
+    @classmethod
+    def make_key(cls, query: str, limit, *extra) -> tuple:
+        return (cls.normalize(query), limit, *extra)
+
+    def get(self, key) -> tuple:
+        # Returns (found, value) so that cached empty results still count as hits
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return False, None
+
+            expires, size, value = entry
+            if expires < time.monotonic():
+                self._remove(key)
+                self.misses += 1
+                return False, None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return True, value
+
+    def put(self, key, value):
+        size = self.estimate_size(value)
+
+        # Results bigger than the whole budget are not cached
+        if size > self.max_bytes:
+            return
+
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.monotonic() + self.ttl_seconds, size, value)
+            self.size_bytes += size
+
+            # Evict least recently used entries until we are within budget again
+            while len(self._entries) > self.max_entries or self.size_bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate(self):
+        with self._lock:
+            self._entries.clear()
+            self.size_bytes = 0
+            self.invalidations += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "size_bytes": self.size_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups > 0 else None,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations
+                }
+
+    def _remove(self, key):
+        _, size, _ = self._entries.pop(key)
+        self.size_bytes -= size
+
+    @classmethod
+    def estimate_size(cls, value) -> int:
+        # Rough deep size of a query result, neo4j nodes and relationships are sized by their properties
+        if isinstance(value, (str, bytes, int, float, bool)) or value is None:
+            return sys.getsizeof(value)
+        if isinstance(value, dict):
+            return sys.getsizeof(value) + sum(
+                cls.estimate_size(key) + cls.estimate_size(item) for key, item in value.items()
+                )
+        if isinstance(value, (list, tuple, set)):
+            return sys.getsizeof(value) + sum(cls.estimate_size(item) for item in value)
+        if hasattr(value, "memory_usage"):
+            # pandas frames and series
+            usage = value.memory_usage(deep=True)
+            return int(usage.sum() if hasattr(usage, "sum") else usage)
+        if hasattr(value, "items"):
+            return sys.getsizeof(value) + cls.estimate_size(dict(value.items()))
+        return sys.getsizeof(value)
@@ -0,0 +1,96 @@
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+import uuid
+
+class QueryCancelled(Exception):
+    pass
+
+class QueryJob:
+    # A query running on a background thread, so the dashboard can show its progress and cancel it
+    PREVIEW_ROWS = 250
+    _executor = None
+    _executor_lock = threading.Lock()
+
+    def __init__(
+        self, graph_db, query: str, query_limit: int, example_key: str, timeout: float | None = None,
+        trace=None, profile: bool = False, parameters: dict | None = None
+        ):
+        self.graph_db = graph_db
+        self.example_key = example_key
+        self.job_id = uuid.uuid4().hex
+        self.started = time.monotonic()
+        self.finished = None
+        self.cancelled = False
+        self.trace = trace
+
+        # Number of rows received so far and the first of them, filled by the worker while the result
+        # streams in. The rows themselves go straight into the frames, see GraphDB.run_query_frame
+        self.row_count = 0
+        self.preview = []
+
+        self.future = self.executor().submit(
+            self._run, query, query_limit, example_key, timeout, profile, parameters
+            )
+
+    @classmethod
+    def executor(cls, max_workers: int = 8) -> ThreadPoolExecutor:
+        with cls._executor_lock:
+            if cls._executor is None:
+                cls._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="query")
+            return cls._executor
+
+    def _run(
+        self, query: str, query_limit: int, example_key: str, timeout: float | None, profile: bool,
+        parameters: dict | None
+        ):
+        try:
+            # Frames per label (or one table), see GraphDB.run_query_frame
+            return self.graph_db.run_query_frame(
+                query=query,
+                query_limit=query_limit,
+                example_key=example_key,
+                on_chunk=self._progress,
+                timeout=timeout,
+                # The job id is attached to the transaction so it can be found again to terminate it
+                metadata={"job_id": self.job_id},
+                trace=self.trace,
+                profile=profile,
+                parameters=parameters
+                )
+        finally:
+            self.finished = time.monotonic()
+
+    def _progress(self, chunk: list):
+        # Stop reading a cancelled query, closing the session rolls its transaction back
+        if self.cancelled:
+            raise QueryCancelled("The query was cancelled")
+        self.row_count += len(chunk)
+        if len(self.preview) < self.PREVIEW_ROWS:
+            self.preview.extend(chunk[:self.PREVIEW_ROWS - len(self.preview)])
+
+    def done(self) -> bool:
+        return self.future.done()
+
+    def elapsed(self) -> float:
+        return (self.finished or time.monotonic()) - self.started
+
+    def result(self):
+        # Raises the exception of the query if it failed, timed out or was cancelled
+        return self.future.result()
+
+    def cancel(self, wait_seconds: float = 5.0, poll_seconds: float = 0.1) -> bool:
+        # Returns whether the query was stopped. A transaction that just started may not be listed by
+        # SHOW TRANSACTIONS yet, so terminating is retried until it is found or the query has ended
+        self.cancelled = True
+        if self.future.cancel():
+            return True
+        
+        deadline = time.monotonic() + wait_seconds
+        while not self.future.done():
+            if self.graph_db.terminate_transactions(self.job_id) > 0:
+                return True
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(poll_seconds)
+        return self.future.cancelled() or isinstance(self.future.exception(), QueryCancelled)
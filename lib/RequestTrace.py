@@ -0,0 +1,85 @@
+from contextlib import contextmanager
+from datetime import datetime, timezone
+import json
+import os
+import threading
+import time
+
+class RequestTrace:
+    # Collects the wall time of every stage of one dashboard request and the
+    # database summaries of its queries, so slow interactions can be traced back
+    def __init__(self, name: str, **details):
+        self.name = name
+        self.details = details
+        self.started_at = datetime.now(timezone.utc).isoformat()
+        self.stages = []
+        self.queries = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name: str, **details):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_stage(name, time.perf_counter() - start, **details)
+
+    def add_stage(self, name: str, seconds: float, **details):
+        with self._lock:
+            self.stages.append({"stage": name, "ms": round(seconds * 1000, 2), **details})
+
+    def add_query(self, query: str, summary, **details):
+        # Keep the timings and counters of the neo4j ResultSummary, and the db hits when the query was profiled
+        entry = {
+            "query": query,
+            "result_available_after_ms": summary.result_available_after,
+            "result_consumed_after_ms": summary.result_consumed_after,
+            "counters": {
+                key: value for key, value in vars(summary.counters).items()
+                if not key.startswith("_") and value
+                },
+            **details
+            }
+        if summary.profile is not None:
+            entry["db_hits"] = self.total_db_hits(summary.profile)
+            entry["plan"] = self.compact_plan(summary.profile)
+        with self._lock:
+            self.queries.append(entry)
+
+    @classmethod
+    def total_db_hits(cls, plan: dict) -> int:
+        return plan.get("dbHits", 0) + sum(cls.total_db_hits(child) for child in plan.get("children", []))
+
+    @classmethod
+    def compact_plan(cls, plan: dict, depth: int = 0) -> list:
+        # The operators of the plan from top to bottom with their rows and db hits
+        operators = [{
+            "operator": "  " * depth + plan["operatorType"].split("@")[0],
+            "rows": plan.get("rows"),
+            "db_hits": plan.get("dbHits")
+            }]
+        for child in plan.get("children", []):
+            operators.extend(cls.compact_plan(child, depth + 1))
+        return operators
+
+    def total_ms(self) -> float:
+        return round(sum(stage["ms"] for stage in self.stages), 2)
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            return {
+                "name": self.name,
+                "started_at": self.started_at,
+                "total_ms": self.total_ms(),
+                **self.details,
+                "stages": list(self.stages),
+                "queries": list(self.queries)
+                }
+
+    def write(self, log_path: str):
+        # Append the trace as one JSON line to the structured log
+        directory = os.path.dirname(log_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(log_path, "a", encoding="utf-8") as log_file:
+            log_file.write(json.dumps(self.to_dict(), default=str) + "\n")
@@ -0,0 +1,212 @@
+import time
+
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+
+from lib import Geo, Pipeline
+from lib.AnalyticsEngine import AnalyticsEngine
+
+class ScenarioEngine:
+    # What-if scenarios on the closest hospitals of every SA2: open a hospital at a coordinate or close one.
+    # Only the SA2s whose closest hospitals can change are recomputed, found with KD-trees over the
+    # SA2 centroids and the hospital coordinates. Travel times of new pairs are estimated from the
+    # distance at the typical road speed of the known travel times
+    threshold_bands = 8
+    def __init__(self, engine: AnalyticsEngine, k: int = 5):
+        self.k = k
+        self.sa2_names = engine.sa2_names
+        self.sa2_population = engine.sa2_population
+        self.base_hospitals = len(engine.hospitals)
+        self.hospital_ids = np.array([node.get("id") for node in engine.hospitals], dtype=object)
+        self.hospital_names = np.array([node.get("hospital_name") for node in engine.hospitals], dtype=object)
+        self.hospital_latitude = np.array([AnalyticsEngine._number(node.get("latitude")) for node in engine.hospitals])
+        self.hospital_longitude = np.array([AnalyticsEngine._number(node.get("longitude")) for node in engine.hospitals])
+
+        # The k closest hospitals of every SA2 as positions in the hospital arrays, padded with -1 and inf
+        found = np.minimum(np.diff(engine.indptr), k)
+        present = np.arange(k)[None, :] < found[:, None]
+        entries = (engine.indptr[:-1, None] + np.arange(k)[None, :])[present]
+        self.base_nearest = np.full((len(found), k), -1, dtype=np.int64)
+        self.base_durations = np.full((len(found), k), np.inf)
+        self.base_nearest[present] = engine.edge_hospital[entries]
+        self.base_durations[present] = engine.edge_distance[entries]
+
+        # The SA2s have no coordinates, estimate them from their hospitals weighted by travel time
+        # (like GraphDB.refresh_sa2_summary), and index the ones that could be placed
+        latitude = np.where(present, self.hospital_latitude[self.base_nearest], np.nan)
+        longitude = np.where(present, self.hospital_longitude[self.base_nearest], np.nan)
+        weights = np.where(np.isfinite(latitude) & np.isfinite(longitude), 1 / (self.base_durations + 60), 0)
+        with np.errstate(invalid="ignore"):
+            self.sa2_latitude = np.nansum(latitude * weights, axis=1) / weights.sum(axis=1)
+            self.sa2_longitude = np.nansum(longitude * weights, axis=1) / weights.sum(axis=1)
+        self.sa2_located = np.flatnonzero(np.isfinite(self.sa2_latitude))
+
+        # Typical seconds per kilometre of the known travel times
+        kilometres = Geo.haversine(self.sa2_latitude[:, None], self.sa2_longitude[:, None], latitude, longitude)
+        usable = present & np.isfinite(kilometres) & (kilometres > 1)
+        self.seconds_per_kilometre = float(np.median(self.base_durations[usable] / kilometres[usable])) if usable.any() else 60.0
+
+        self.reset()
+
+    def reset(self):
+        # Back to the hospitals and travel times of the graph
+        self.nearest = self.base_nearest.copy()
+        self.durations = self.base_durations.copy()
+        self.hospital_ids = self.hospital_ids[:self.base_hospitals]
+        self.hospital_names = self.hospital_names[:self.base_hospitals]
+        self.hospital_latitude = self.hospital_latitude[:self.base_hospitals]
+        self.hospital_longitude = self.hospital_longitude[:self.base_hospitals]
+        self.hospital_open = np.ones(self.base_hospitals, dtype=bool)
+        self.changes = []
+        self._build_hospital_tree()
+        self.sa2_bands = None
+
+    def _build_hospital_tree(self):
+        # Only open hospitals with coordinates can replace a closed one
+        located = self.hospital_open & np.isfinite(self.hospital_latitude) & np.isfinite(self.hospital_longitude)
+        self.hospital_located = np.flatnonzero(located)
+        self.hospital_tree = cKDTree(Geo.to_unit_vectors(self.hospital_latitude[located], self.hospital_longitude[located]))
+
+    def _build_sa2_bands(self):
+        # The placed SA2s grouped by how far away a new hospital can be and still be among their k closest,
+        # with a KD-tree per group. Every group is searched with the largest reach of its own members
+        # instead of searching all SA2s with the largest reach overall
+        threshold = self.durations[self.sa2_located, -1]
+        finite = np.isfinite(threshold)
+        rows = self.sa2_located[finite]
+        reach = threshold[finite] / self.seconds_per_kilometre
+        self.sa2_unbounded = self.sa2_located[~finite]
+        self.sa2_bands = []
+        if len(rows) == 0:
+            return
+        
+        edges = np.quantile(reach, np.linspace(0, 1, self.threshold_bands + 1)[1:-1])
+        bands = np.searchsorted(edges, reach)
+        for band in np.unique(bands):
+            members = rows[bands == band]
+            self.sa2_bands.append((
+                members,
+                reach[bands == band].max(),
+                cKDTree(Geo.to_unit_vectors(self.sa2_latitude[members], self.sa2_longitude[members]))
+                ))
+
+    def estimate(self, sa2_positions: np.ndarray, latitude, longitude) -> np.ndarray:
+        return Geo.haversine(self.sa2_latitude[sa2_positions], self.sa2_longitude[sa2_positions], latitude, longitude) * self.seconds_per_kilometre
+
+    ### SCENARIOS
+    def open_hospital(self, latitude: float, longitude: float, name: str = "New hospital") -> pd.DataFrame:
+        # Add a hospital and put it among the closest hospitals of the SA2s it is closer to
+        start = time.perf_counter()
+        position = len(self.hospital_ids)
+        self.hospital_ids = np.append(self.hospital_ids, f"new-{position - self.base_hospitals + 1}")
+        self.hospital_names = np.append(self.hospital_names, name)
+        self.hospital_latitude = np.append(self.hospital_latitude, latitude)
+        self.hospital_longitude = np.append(self.hospital_longitude, longitude)
+        self.hospital_open = np.append(self.hospital_open, True)
+        self._build_hospital_tree()
+
+        # Only SA2s within reach of their k-th closest hospital can be affected, SA2s with fewer
+        # than k hospitals take any new hospital
+        if self.sa2_bands is None:
+            self._build_sa2_bands()
+        point = Geo.to_unit_vectors([latitude], [longitude])[0]
+        nearby = [
+            members[np.asarray(tree.query_ball_point(point, Geo.chord_length(reach)), dtype=np.int64)]
+            for members, reach, tree in self.sa2_bands
+            ]
+        candidates = np.unique(np.concatenate([self.sa2_unbounded, *nearby])).astype(np.int64)
+
+        threshold = self.durations[:, -1]
+        estimates = self.estimate(candidates, latitude, longitude)
+        closer = estimates < threshold[candidates]
+        affected = candidates[closer]
+        before = self.sa2_summary(affected)
+        self._merge(affected, np.full((len(affected), 1), position), estimates[closer][:, None])
+        return self._record(f"Open {name}", affected, before, start)
+
+    def close_hospital(self, hospital_id) -> pd.DataFrame:
+        # Remove a hospital from the closest hospitals of its SA2s and fill them up with the next closest
+        start = time.perf_counter()
+        position = int(np.flatnonzero(self.hospital_ids == hospital_id)[0])
+        self.hospital_open[position] = False
+        self._build_hospital_tree()
+
+        affected = np.flatnonzero((self.nearest == position).any(axis=1))
+        before = self.sa2_summary(affected)
+        removed = self.nearest[affected] == position
+        self.nearest[affected] = np.where(removed, -1, self.nearest[affected])
+        self.durations[affected] = np.where(removed, np.inf, self.durations[affected])
+        self._merge(affected, np.empty((len(affected), 0), dtype=np.int64), np.empty((len(affected), 0)))
+
+        # The hospitals closest to the SA2s as replacements, skipping the ones they already have
+        located = affected[np.isfinite(self.sa2_latitude[affected])]
+        count = min(2 * self.k, len(self.hospital_located))
+        if len(located) > 0 and count > 0:
+            _, neighbours = self.hospital_tree.query(
+                Geo.to_unit_vectors(self.sa2_latitude[located], self.sa2_longitude[located]), k=count
+                )
+            candidates = self.hospital_located[np.asarray(neighbours).reshape(len(located), count)]
+            estimates = Geo.haversine(
+                self.sa2_latitude[located][:, None], self.sa2_longitude[located][:, None],
+                self.hospital_latitude[candidates], self.hospital_longitude[candidates]
+                ) * self.seconds_per_kilometre
+            known = (candidates[:, :, None] == self.nearest[located][:, None, :]).any(axis=2)
+            self._merge(located, candidates, np.where(known, np.inf, estimates))
+
+        return self._record(f"Close {self.hospital_names[position]}", affected, before, start)
+
+    def _merge(self, rows: np.ndarray, hospitals: np.ndarray, durations: np.ndarray):
+        # Keep the k closest of the current and the candidate hospitals of the given SA2s,
+        # their reach changes so the bands are built again before the next hospital is opened
+        if len(rows) > 0:
+            self.sa2_bands = None
+        merged_hospitals = np.concatenate([self.nearest[rows], hospitals], axis=1)
+        merged_durations = np.concatenate([self.durations[rows], durations], axis=1)
+        order = np.argsort(merged_durations, axis=1, kind="stable")[:, :self.k]
+        self.durations[rows] = np.take_along_axis(merged_durations, order, axis=1)
+        self.nearest[rows] = np.where(np.isfinite(self.durations[rows]), np.take_along_axis(merged_hospitals, order, axis=1), -1)
+
+    ### RESULTS
+    def sa2_summary(self, rows: np.ndarray) -> dict:
+        # Closest hospital and the number of accessible and too far hospitals among the closest ones
+        durations = self.durations[rows]
+        closest = self.nearest[rows, 0]
+        return {
+            "closest_hospital": np.where(closest >= 0, self.hospital_names[np.maximum(closest, 0)], None),
+            "closest_distance": np.where(np.isfinite(durations[:, 0]), durations[:, 0], np.nan),
+            "accessible": (durations < Pipeline.ACCESSIBLE_SECONDS).sum(axis=1),
+            "further_than_2h": (np.isfinite(durations) & (durations > Pipeline.FAR_SECONDS)).sum(axis=1)
+            }
+
+    def _record(self, description: str, rows: np.ndarray, before: dict, start: float) -> pd.DataFrame:
+        after = self.sa2_summary(rows)
+        report = pd.DataFrame({
+            "SA2 Name": self.sa2_names[rows],
+            "Population": self.sa2_population[rows],
+            "Closest Hospital (before)": before["closest_hospital"],
+            "Closest Hospital (after)": after["closest_hospital"],
+            "Closest Distance (before)": before["closest_distance"],
+            "Closest Distance (after)": after["closest_distance"],
+            "Accessible (before)": before["accessible"],
+            "Accessible (after)": after["accessible"],
+            "Further than 2 hours (before)": before["further_than_2h"],
+            "Further than 2 hours (after)": after["further_than_2h"]
+            })
+        self.changes.append({
+            "change": description,
+            "affected_sa2": len(rows),
+            "milliseconds": round((time.perf_counter() - start) * 1000, 2)
+            })
+        return report
+
+    def summary(self) -> dict:
+        # SA2s and population without an accessible hospital, now and in the graph
+        without = self.durations[:, 0] >= Pipeline.ACCESSIBLE_SECONDS
+        base_without = self.base_durations[:, 0] >= Pipeline.ACCESSIBLE_SECONDS
+        return {
+            "sa2_without_accessible": int(without.sum()),
+            "base_sa2_without_accessible": int(base_without.sum()),
+            "population_without_accessible": float(np.nansum(self.sa2_population[without])),
+            "base_population_without_accessible": float(np.nansum(self.sa2_population[base_without]))
+            }
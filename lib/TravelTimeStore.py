@@ -0,0 +1,226 @@
+import argparse
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+class TravelTimeStore:
+    # The SA2 x hospital travel times as sparse arrays on disk, memory-mapped so a lookup only reads
+    # the pages it needs. The rows (per SA2) and the columns (per hospital) are both stored CSR-style:
+    # an int64 offset array, int32 positions into the other id array and float32 durations, every
+    # row and column sorted by duration so the nearest hospitals of a SA2 are its first entries
+    def __init__(self, path: str):
+        self.path = path
+        with open(os.path.join(path, "meta.json")) as meta_file:
+            self.meta = json.load(meta_file)
+        if not self.meta["complete"]:
+            raise ValueError(f"Travel time store {path} was not finished")
+
+        self.sa2_ids = np.load(os.path.join(path, "sa2_ids.npy"))
+        self.hospital_ids = np.load(os.path.join(path, "hospital_ids.npy"))
+        self.indptr = np.load(os.path.join(path, "indptr.npy"), mmap_mode="r")
+        self.hospital_indptr = np.load(os.path.join(path, "hospital_indptr.npy"), mmap_mode="r")
+
+        entries = self.meta["entries"]
+        self.indices = self._map("indices.bin", np.int32, entries)
+        self.durations = self._map("durations.bin", np.float32, entries)
+        self.hospital_indices = self._map("hospital_indices.bin", np.int32, entries)
+        self.hospital_durations = self._map("hospital_durations.bin", np.float32, entries)
+
+        self._sa2_positions = {sa2_id: position for position, sa2_id in enumerate(self.sa2_ids.tolist())}
+        self._hospital_positions = {hospital_id: position for position, hospital_id in enumerate(self.hospital_ids.tolist())}
+
+    def _map(self, name: str, dtype, entries: int, mode: str = "r") -> np.ndarray:
+        # An empty file can not be memory-mapped
+        if entries == 0:
+            return np.empty(0, dtype=dtype)
+        return np.memmap(os.path.join(self.path, name), dtype=dtype, mode=mode, shape=(entries,))
+
+    ### WRITING
+    @classmethod
+    def create(cls, path: str, hospital_ids: np.ndarray, cutoff: float | None = None, keep_nearest: int = 5) -> "TravelTimeStore":
+        # Start a new store, the rows are added in blocks with append and the store is readable after finish.
+        # Durations above the cutoff (seconds) are dropped, except for the keep_nearest closest hospitals
+        os.makedirs(path, exist_ok=True)
+        store = cls.__new__(cls)
+        store.path = path
+        store.meta = {
+            "sa2": 0,
+            "hospitals": len(hospital_ids),
+            "entries": 0,
+            "cutoff": cutoff,
+            "keep_nearest": keep_nearest,
+            "complete": False
+            }
+        store.hospital_ids = np.asarray(hospital_ids, dtype=np.int64)
+        store._sa2_blocks = []
+        store._length_blocks = []
+        store._files = {
+            "indices": open(os.path.join(path, "indices.bin"), "wb"),
+            "durations": open(os.path.join(path, "durations.bin"), "wb")
+            }
+        store._write_meta()
+        return store
+
+    def append(self, sa2_ids: np.ndarray, durations: np.ndarray):
+        # Add the rows of a dense SA2 x hospital block, missing durations are NaN
+        filled = np.where(np.isnan(durations), np.inf, durations)
+        order = np.argsort(filled, axis=1, kind="stable")
+        sorted_durations = np.take_along_axis(filled, order, axis=1)
+
+        # Sorted rows keep a prefix: the finite durations up to the cutoff and at least the nearest ones
+        keep = np.isfinite(sorted_durations)
+        if self.meta["cutoff"] is not None:
+            nearest = np.arange(filled.shape[1]) < self.meta["keep_nearest"]
+            keep &= (sorted_durations <= self.meta["cutoff"]) | nearest[None, :]
+
+        self._files["indices"].write(order[keep].astype(np.int32).tobytes())
+        self._files["durations"].write(sorted_durations[keep].astype(np.float32).tobytes())
+        self._sa2_blocks.append(np.asarray(sa2_ids, dtype=np.int64))
+        self._length_blocks.append(keep.sum(axis=1))
+
+    def finish(self, block_entries: int = 1_000_000) -> "TravelTimeStore":
+        # Write the row offsets and build the per hospital index from the rows, block by block
+        for file in self._files.values():
+            file.close()
+
+        sa2_ids = np.concatenate(self._sa2_blocks) if self._sa2_blocks else np.empty(0, dtype=np.int64)
+        lengths = np.concatenate(self._length_blocks) if self._length_blocks else np.empty(0, dtype=np.int64)
+        indptr = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+        entries = int(indptr[-1])
+        np.save(os.path.join(self.path, "sa2_ids.npy"), sa2_ids)
+        np.save(os.path.join(self.path, "hospital_ids.npy"), self.hospital_ids)
+        np.save(os.path.join(self.path, "indptr.npy"), indptr)
+
+        indices = self._map("indices.bin", np.int32, entries)
+        durations = self._map("durations.bin", np.float32, entries)
+        n_hospitals = len(self.hospital_ids)
+
+        # Count the entries per hospital, then scatter every block of rows to its place in the columns
+        counts = np.zeros(n_hospitals, dtype=np.int64)
+        for start in range(0, entries, block_entries):
+            counts += np.bincount(indices[start:start + block_entries], minlength=n_hospitals)
+        hospital_indptr = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        np.save(os.path.join(self.path, "hospital_indptr.npy"), hospital_indptr)
+
+        hospital_indices = self._map("hospital_indices.bin", np.int32, entries, mode="w+")
+        hospital_durations = self._map("hospital_durations.bin", np.float32, entries, mode="w+")
+        next_free = hospital_indptr[:-1].copy()
+        row = 0
+        while row < len(lengths):
+            # Whole rows up to about block_entries entries
+            last = max(row + 1, int(np.searchsorted(indptr, indptr[row] + block_entries, side="right")) - 1)
+            last = min(last, len(lengths))
+            block = slice(indptr[row], indptr[last])
+            columns = np.asarray(indices[block])
+            rows = np.repeat(np.arange(row, last, dtype=np.int32), lengths[row:last])
+
+            order = np.argsort(columns, kind="stable")
+            sorted_columns = columns[order]
+            block_counts = np.bincount(sorted_columns, minlength=n_hospitals)
+            rank = np.arange(len(sorted_columns)) - (np.cumsum(block_counts) - block_counts)[sorted_columns]
+            positions = next_free[sorted_columns] + rank
+            hospital_indices[positions] = rows[order]
+            hospital_durations[positions] = np.asarray(durations[block])[order]
+            next_free += block_counts
+            row = last
+
+        # Sort every hospital column by duration as well
+        for column in range(n_hospitals):
+            segment = slice(hospital_indptr[column], hospital_indptr[column + 1])
+            order = np.argsort(hospital_durations[segment], kind="stable")
+            hospital_indices[segment] = hospital_indices[segment][order]
+            hospital_durations[segment] = hospital_durations[segment][order]
+        for array in (hospital_indices, hospital_durations):
+            if isinstance(array, np.memmap):
+                array.flush()
+
+        self.meta.update({"sa2": len(sa2_ids), "entries": entries, "complete": True})
+        self._write_meta()
+        return TravelTimeStore(self.path)
+
+    def _write_meta(self):
+        with open(os.path.join(self.path, "meta.json"), "w") as meta_file:
+            json.dump(self.meta, meta_file)
+
+    ### READING
+    def row(self, sa2_id) -> tuple:
+        # Hospital ids and durations of a SA2, nearest first
+        position = self._sa2_positions[sa2_id]
+        entries = slice(self.indptr[position], self.indptr[position + 1])
+        return self.hospital_ids[self.indices[entries]], np.asarray(self.durations[entries])
+
+    def column(self, hospital_id) -> tuple:
+        # SA2 ids and durations of a hospital, nearest first
+        position = self._hospital_positions[hospital_id]
+        entries = slice(self.hospital_indptr[position], self.hospital_indptr[position + 1])
+        return self.sa2_ids[self.hospital_indices[entries]], np.asarray(self.hospital_durations[entries])
+
+    def nearest(self, sa2_id, k: int = 5) -> tuple:
+        hospital_ids, durations = self.row(sa2_id)
+        return hospital_ids[:k], durations[:k]
+
+    def nearest_all(self, k: int = 5) -> tuple:
+        # The k nearest hospital ids and durations of every SA2 as n x k arrays, padded with -1 and NaN,
+        # and the number found per SA2. Only the first k entries of every row are read
+        found = np.minimum(np.diff(self.indptr), k)
+        present = np.arange(k)[None, :] < found[:, None]
+        entries = (self.indptr[:-1, None] + np.arange(k)[None, :])[present]
+
+        hospital_ids = np.full((len(found), k), -1, dtype=np.int64)
+        durations = np.full((len(found), k), np.nan, dtype=np.float64)
+        hospital_ids[present] = self.hospital_ids[self.indices[entries]]
+        durations[present] = self.durations[entries]
+        return hospital_ids, durations, found
+
+    def shortest(self) -> np.ndarray:
+        # Shortest duration per SA2, NaN when no hospital is reachable
+        lengths = np.diff(self.indptr)
+        shortest = np.full(len(lengths), np.nan, dtype=np.float64)
+        shortest[lengths > 0] = self.durations[self.indptr[:-1][lengths > 0]]
+        return shortest
+
+    def edges(self, start: int = 0, stop: int | None = None) -> tuple:
+        # All stored entries of the SA2s at positions start to stop as flat sa2 id, hospital id and duration arrays
+        stop = len(self.sa2_ids) if stop is None else min(stop, len(self.sa2_ids))
+        entries = slice(self.indptr[start], self.indptr[stop])
+        return (
+            np.repeat(self.sa2_ids[start:stop], np.diff(self.indptr[start:stop + 1])),
+            self.hospital_ids[self.indices[entries]],
+            np.asarray(self.durations[entries], dtype=np.float64)
+            )
+
+def convert(source: str, path: str, cutoff: float | None = None, keep_nearest: int = 5, chunk_rows: int = 1000) -> TravelTimeStore:
+    # Convert the wide duration table, a pickle (read once) or a csv (read in chunks) with a SA2_5DIG16 column
+    # and one column per hospital, as read by Pipeline.distance_matrix. Pipeline imports this module, so it is imported here
+    from lib import Pipeline
+
+    if source.endswith(".pkl"):
+        data = pd.read_pickle(source)
+        chunks = (data.iloc[start:start + chunk_rows] for start in range(0, len(data), chunk_rows))
+    else:
+        chunks = pd.read_csv(source, chunksize=chunk_rows)
+
+    store = None
+    for chunk in chunks:
+        sa2_ids, hospital_ids, durations = Pipeline.distance_matrix(chunk)
+        if store is None:
+            store = TravelTimeStore.create(path, hospital_ids, cutoff, keep_nearest)
+        store.append(sa2_ids, durations)
+    return store.finish()
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert a SA2 x hospital duration table to a memory-mapped travel time store")
+    parser.add_argument("--source", default="data/original/duration_sa2_hospitals.pkl", help="Wide duration table, .pkl or .csv")
+    parser.add_argument("--savedir", default="data/processed/travel_times", help="Directory to write the store to")
+    parser.add_argument("--cutoff", type=float, default=None, help="Drop durations above this many seconds")
+    parser.add_argument("--keep-nearest", type=int, default=5, help="Closest hospitals kept per SA2 regardless of the cutoff")
+    parser.add_argument("--chunk-rows", type=int, default=1000, help="SA2 rows converted at once")
+    args = parser.parse_args()
+
+    store = convert(args.source, args.savedir, args.cutoff, args.keep_nearest, args.chunk_rows)
+    print(f"sa2: {store.meta['sa2']}, hospitals: {store.meta['hospitals']}, entries: {store.meta['entries']}")
+
+if __name__ == "__main__":
+    main()
@@ -1,102 +1,242 @@
-import streamlit as st
-import networkx as nx
-from pyvis.network import Network
-import streamlit.components.v1 as components
-import pandas as pd
-import os
+# streamlit and pyvis are imported by the methods that use them, so building graphs
+# (e.g. in the benchmarks) does not pay for them
+from collections import OrderedDict
+import hashlib
+import json
+import math
+import threading
+import time
+
+from lib import Geo
+
+# Line of the PyVis template after which the network object exists
+NETWORK_CREATED = "network = new vis.Network(container, data, options);"
 
 class Visualizer:
+    # Rendered graphs and projected node positions are shared by all sessions of the process
+    max_cached_graphs = 16
+    max_cached_renders = 32
+    _graphs = OrderedDict()
+    _renders = OrderedDict()
+    _positions = {}
+    _lock = threading.Lock()
+
     def __init__(self):
         pass
-    
+
     # Define a function to normalize population sizes
     def normalize_population(self, pop, min_pop, max_pop, min_size=10, max_size=50):
         # Normalizes population to a range between min_size and max_size
+        if max_pop == min_pop:
+            return (min_size + max_size) / 2
         return min_size + (pop - min_pop) * (max_size - min_size) / (max_pop - min_pop)
 
-    
-    def graph_display(self, data: list, colors: dict, height: int = 600, node_distance: int = 500, population_scaling: bool = False):
-        graph_data = ({
-            'hospital': row["hospital"]["hospital_name"],
-            'sa2': row["sa2"]["sa2_name"],
-            'distance_time': row["relation"]["distance_time"]} for row in data if None not in row.values())
-        
-        dict_data = {
-            'hospitals': {row["hospital"]["hospital_name"]: row["hospital"] for row in data if None not in row.values()} ,
-            'sa2': {row["sa2"]["sa2_name"]: row["sa2"] for row in data if None not in row.values()},
-            'relation': {f"{row["hospital"]["hospital_name"]}_{row["sa2"]["sa2_name"]}": row["relation"] for row in data if None not in row.values()}
-            }
-        
-        df_select = pd.DataFrame(graph_data, columns=['hospital', 'sa2', 'distance_time'])  
 
-        if len(df_select) > 0:
-            G = nx.from_pandas_edgelist(df_select, 'hospital', 'sa2', ['distance_time'])
-        else:
-            G = nx.Graph()
-
-        # Add nodes without edges
-        for row in data:
-            if None in row.values():
-                if row["hospital"] is not None:
-                    G.add_node(row["hospital"]["hospital_name"])
-                    dict_data["hospitals"][row["hospital"]["hospital_name"]] = row["hospital"]
-                if row["sa2"] is not None:
-                    G.add_node(row["sa2"]["sa2_name"])
-                    dict_data["sa2"][row["sa2"]["sa2_name"]] = row["sa2"]
+    def graph_display(
+        self, data: dict, colors: dict, height: int = 600, 
+        node_distance: int = 500, population_scaling: bool = False,
+        level_of_detail: bool = False, cluster_by: str = "nearest", detail_threshold: int = 300,
+        layout: str = "force", trace=None, data_key: str | None = None
+        ):
+        import streamlit as st
+        import streamlit.components.v1 as components
+
+        # data are the frames of a result (see GraphDB.to_frames), data_key identifies them: pass fingerprint(data)
+        # computed once when the result is stored instead of hashing the whole result on every rerun
+        start = time.perf_counter()
+        graph_key = (data_key or self.fingerprint(data), self.fingerprint(colors))
+        graph = self._cache_get(self._graphs, graph_key)
+        cached = graph is not None
+        if graph is None:
+            graph = self.build_graph(data, colors)
+            self._cache_put(self._graphs, graph_key, graph, self.max_cached_graphs)
+        if trace is not None:
+            trace.add_stage("build graph", time.perf_counter() - start, hit=cached, nodes=len(graph["nodes"]))
 
         # Check if graph is empty
-        if len(G.nodes) == 0:
+        if len(graph["nodes"]) == 0:
             st.error("No data to display")
             st.stop()
 
-        # Initiate PyVis network object
-        network = Network(
+        # The HTML is cached on the graph and the display settings it depends on, the clustered
+        # render has a fixed layout and node sizes so the node distance and scaling are left out
+        start = time.perf_counter()
+        clustered = level_of_detail and len(graph["nodes"]) > detail_threshold
+        if clustered:
+            render_key = (*graph_key, height, "clustered", cluster_by, layout)
+        else:
+            render_key = (*graph_key, height, node_distance, population_scaling, layout)
+        html = self._cache_get(self._renders, render_key)
+        if trace is not None:
+            trace.add_stage("render cache", time.perf_counter() - start, hit=html is not None)
+
+        if html is None:
+            # The geographic layout places the nodes on their coordinates instead of simulating the layout in the browser
+            positions = self.geographic_positions(graph) if layout == "geographic" else None
+            
+            # Large graphs are shown as clusters of SA2 regions with a precomputed layout
+            start = time.perf_counter()
+            if clustered:
+                html = self.render_clustered_html(graph, colors, height, cluster_by, positions)
+            else:
+                html = self.render_html(graph, height, node_distance, population_scaling, positions)
+            self._cache_put(self._renders, render_key, html, self.max_cached_renders)
+            if trace is not None:
+                trace.add_stage("render html", time.perf_counter() - start, kilobytes=round(len(html) / 1024, 1))
+
+        col1, col2 = st.columns(2)
+        col1.warning("Hospital Nodes are yellow")
+        col2.info("SA2 Region Nodes are blue")
+
+        # Load the HTML in a HTML component for display on Streamlit page
+        components.html(html, height=height)
+
+    @staticmethod
+    def network(height: int):
+        # PyVis (and the IPython it loads) is only imported once a graph is rendered
+        from pyvis.network import Network
+
+        return Network(
                         height=f'{height}px',
                         width='100%',
                         bgcolor='#222222',
                         font_color='white'
                         )
 
-        # Take Networkx graph and translate it to a PyVis graph format
-        network.from_nx(G)
-
-        if population_scaling and len(dict_data["sa2"]) > 0:
-            # Get max and min population values for normalization
-            max_population = max(data["population"] for data in dict_data["sa2"].values())
-            min_population = min(data["population"] for data in dict_data["sa2"].values())
-                
-        # Color nodes based on type
-        for node in network.nodes:
-            if node["label"] in dict_data["hospitals"]:
-                related_data = dict_data["hospitals"][node["label"]]
-                node["color"] = colors["Hospital"]
-                node["title"] = f"""Hospital
-                Name: {related_data["hospital_name"]}
-                Phone: {related_data["phone_number"]}
-                Address: {related_data["address"]}
-                Suburb: {related_data["suburb"]}
-                Postcode: {related_data["postcode"]}
-                State: {related_data["state"]}
-                LHN: {related_data["lhn"]}
-                PHN: {related_data["phn"]}
-                Website: {related_data["website"]}
-                Description: {related_data["description"]}
-                Sector: {related_data["sector"]}                
+    def build_graph(self, frames: dict, colors: dict) -> dict:
+        # Nodes are identified by their name, like before, so hospitals or SA2s with the same name share a node
+        nodes = {}
+        names = {"Hospital": {}, "SA2": {}}
+        for hospital in self._records(frames["Hospital"]):
+            nodes.setdefault(hospital.get("hospital_name"), self.hospital_node(hospital, colors))
+            names["Hospital"][hospital.get("id")] = hospital.get("hospital_name")
+        for sa2 in self._records(frames["SA2"]):
+            nodes.setdefault(sa2.get("sa2_name"), self.sa2_node(sa2, colors))
+            names["SA2"][sa2.get("id")] = sa2.get("sa2_name")
+        
+        edges = {}
+        nearest = {}
+        edge_frame = frames["edges"]
+        for hospital_id, sa2_id, distance_time, accessible, further_than_2h in zip(
+            edge_frame["hospital_id"], edge_frame["sa2_id"], edge_frame["distance_time"],
+            edge_frame["accessible"], edge_frame["further_than_2h"]
+            ):
+            relation = {"distance_time": distance_time, "accessible": bool(accessible), "further_than_2h": bool(further_than_2h)}
+            edge = self.edge(names["Hospital"].get(hospital_id), names["SA2"].get(sa2_id), relation, colors)
+            edges[(edge["from"], edge["to"])] = edge
+            
+            # Remember the closest hospital of every SA2 for clustering
+            if edge["to"] not in nearest or edge["value"] < nearest[edge["to"]]["value"]:
+                nearest[edge["to"]] = edge
+        
+        for sa2_name, edge in nearest.items():
+            nodes[sa2_name]["nearest_hospital"] = edge["from"]
+
+        return {
+            "nodes": list(nodes.values()),
+            "edges": list(edges.values())
+            }
+
+    @staticmethod
+    def _records(frame) -> list:
+        # Node properties as dictionaries, with None for the properties a node does not have
+        if len(frame) == 0:
+            return []
+        return frame.astype(object).where(frame.notna(), None).to_dict("records")
+
+    @staticmethod
+    def hospital_node(related_data, colors: dict) -> dict:
+        return {
+            "id": related_data.get("hospital_name"),
+            "label": related_data.get("hospital_name"),
+            "shape": "dot",
+            "size": 10,
+            "color": colors["Hospital"],
+            "node_type": "Hospital",
+            "node_id": related_data.get("id"),
+            "state": related_data.get("state"),
+            "latitude": related_data.get("latitude"),
+            "longitude": related_data.get("longitude"),
+            "title": f"""Hospital
+                Name: {related_data.get("hospital_name")}
+                Phone: {related_data.get("phone_number")}
+                Address: {related_data.get("address")}
+                Suburb: {related_data.get("suburb")}
+                Postcode: {related_data.get("postcode")}
+                State: {related_data.get("state")}
+                LHN: {related_data.get("lhn")}
+                PHN: {related_data.get("phn")}
+                Website: {related_data.get("website")}
+                Description: {related_data.get("description")}
+                Sector: {related_data.get("sector")}
                 """
-            else:
-                related_data = dict_data["sa2"][node["label"]]
-                node["color"] = colors["SA2"]
-                node["title"] = f"""SA2 Region
-                Name: {related_data["sa2_name"]}
-                Area: {related_data["area"]}
-                Population: {related_data["population"]}
-                Population Percentage: {round(related_data["pop_percentage"], 2)}
-                Population Density: {related_data["pop_density"]}
+            }
+
+    @staticmethod
+    def sa2_node(related_data, colors: dict) -> dict:
+        return {
+            "id": related_data.get("sa2_name"),
+            "label": related_data.get("sa2_name"),
+            "shape": "dot",
+            "size": 10,
+            "color": colors["SA2"],
+            "node_type": "SA2",
+            "node_id": related_data.get("id"),
+            "population": related_data.get("population") or 0,
+            "latitude": related_data.get("latitude"),
+            "longitude": related_data.get("longitude"),
+            "title": f"""SA2 Region
+                Name: {related_data.get("sa2_name")}
+                Area: {related_data.get("area")}
+                Population: {related_data.get("population")}
+                Population Percentage: {round(related_data.get("pop_percentage") or 0, 2)}
+                Population Density: {related_data.get("pop_density")}
                 """
-                # Scale node size based on population
-                if population_scaling:
-                    node["size"] = self.normalize_population(related_data["population"], min_population, max_population)
+            }
 
+    @staticmethod
+    def edge(hospital_name, sa2_name, related_data, colors: dict) -> dict:
+        distance_time = float(related_data.get("distance_time"))
+        if distance_time > 7200:
+            color = colors["Edges"]["far"]
+        elif distance_time > 1800:
+            color = colors["Edges"]["mid"]
+        else:
+            color = colors["Edges"]["close"]
+
+        return {
+            "from": hospital_name,
+            "to": sa2_name,
+            "value": distance_time,
+            "color": color,
+            "title": f"""Travel time: {round(distance_time, 2)} seconds
+            Accessible: {related_data.get("accessible")}
+            Further than 2 hours: {related_data.get("further_than_2h")}
+            """
+            }
+
+    def render_html(self, graph: dict, height: int, node_distance: int, population_scaling: bool, positions: dict | None = None) -> str:
+        nodes = graph["nodes"]
+
+        # Scale node size based on population, on copies so the cached graph stays as it is
+        if population_scaling:
+            populations = [node["population"] for node in nodes if "population" in node]
+            if len(populations) > 0:
+                max_population = max(populations)
+                min_population = min(populations)
+                nodes = [
+                    {**node, "size": self.normalize_population(node["population"], min_population, max_population)}
+                    if "population" in node else node
+                    for node in nodes
+                    ]
+        
+        if positions is not None:
+            nodes = [{**node, **positions[node["id"]]} for node in nodes]
+
+        # Initiate PyVis network object
+        network = self.network(height)
+        network.nodes = nodes
+        network.edges = graph["edges"]
 
         # Adjust network with specific layout settings
         network.repulsion(
@@ -107,35 +247,204 @@ class Visualizer:
             damping=0.95
         )
         
-        # Add hover functionality
-        for edge in network.edges:
-            dict_key = f"{edge['from']}_{edge['to']}"
-            if dict_key not in dict_data["relation"]:
-                dict_key = f"{edge['to']}_{edge['from']}"
-            related_data = dict_data["relation"][dict_key]
-            edge["title"] = f"""Travel time: {round(float(edge['distance_time']), 2)} seconds
-            Accessible: {related_data["accessible"]}
-            Further than 2 hours: {related_data["further_than_2h"]}
-            """
-            
-            edge["value"] = edge["distance_time"]
-            
-            distance_time = float(edge["distance_time"])
-            if distance_time > 7200:
-                edge["color"] = colors["Edges"]["far"]
-            elif distance_time > 1800:
-                edge["color"] = colors["Edges"]["mid"]
+        # With fixed positions there is nothing to simulate
+        if positions is not None:
+            network.toggle_physics(False)
+
+        return network.generate_html()
+
+    def geographic_positions(self, graph: dict) -> dict:
+        # Project the node coordinates once, the positions are cached per node id
+        positions = {}
+        for node in graph["nodes"]:
+            key = (node["node_type"], node.get("node_id"))
+            with self._lock:
+                position = self._positions.get(key)
+            if position is None and Geo.valid_coordinates(node.get("latitude"), node.get("longitude")):
+                position = Geo.project(node["latitude"], node["longitude"])
+                with self._lock:
+                    self._positions[key] = position
+            if position is not None:
+                positions[node["id"]] = position
+
+        # Nodes without coordinates are placed between their neighbours, weighted by travel time
+        neighbours = {}
+        for edge in graph["edges"]:
+            neighbours.setdefault(edge["to"], []).append((edge["from"], edge["value"]))
+            neighbours.setdefault(edge["from"], []).append((edge["to"], edge["value"]))
+        for node in graph["nodes"]:
+            if node["id"] in positions:
+                continue
+            weighted = [
+                (positions[other], 1 / (distance_time + 60))
+                for other, distance_time in neighbours.get(node["id"], [])
+                if other in positions
+                ]
+            # A small offset based on the name keeps nodes with the same neighbours apart
+            offset = int(hashlib.md5(str(node["id"]).encode("utf-8")).hexdigest()[:4], 16) / 65535 * 2 * math.pi
+            if len(weighted) > 0:
+                total = sum(weight for _, weight in weighted)
+                positions[node["id"]] = {
+                    "x": round(sum(position["x"] * weight for position, weight in weighted) / total + 15 * math.cos(offset), 1),
+                    "y": round(sum(position["y"] * weight for position, weight in weighted) / total + 15 * math.sin(offset), 1)
+                    }
             else:
-                edge["color"] = colors["Edges"]["close"]
+                positions[node["id"]] = {"x": round(100 * math.cos(offset), 1), "y": round(100 * math.sin(offset), 1)}
+        return positions
 
-        # Save and read graph as HTML file (on Streamlit Sharing)
-        file_path = os.path.join("pyvis_graph.html")
-        network.save_graph(file_path)
-        HtmlFile = open(file_path, 'r', encoding='utf-8')
+    def render_clustered_html(self, graph: dict, colors: dict, height: int, cluster_by: str, positions: dict | None = None) -> str:
+        groups = self.cluster_nodes(graph, cluster_by)
+        if positions is None:
+            positions = self.cluster_layout(groups)
 
-        col1, col2 = st.columns(2)
-        col1.warning("Hospital Nodes are yellow")
-        col2.info("SA2 Region Nodes are blue")
+        cluster_of = {node["id"]: key for key, members in groups.items() for node in members}
+        nodes = [{**node, **positions[node["id"]], "cluster": cluster_of[node["id"]]} for node in graph["nodes"]]
+
+        # One super-node per group of SA2 regions, sized by the summed population
+        populations = {
+            key: sum(node.get("population", 0) for node in members if node["node_type"] == "SA2")
+            for key, members in groups.items()
+            }
+        max_population = max(populations.values()) if len(populations) > 0 else 0
+        clusters = []
+        for key, members in groups.items():
+            sa2_members = [node for node in members if node["node_type"] == "SA2"]
+            if len(sa2_members) < 2:
+                continue
+            # The super-node is placed in the middle of its SA2 regions
+            center = {
+                "x": round(sum(positions[node["id"]]["x"] for node in sa2_members) / len(sa2_members), 1),
+                "y": round(sum(positions[node["id"]]["y"] for node in sa2_members) / len(sa2_members), 1)
+                }
+            clusters.append({
+                "key": key,
+                "label": f"{key} ({len(sa2_members)} SA2s)",
+                "title": f"""SA2 Cluster
+                Group: {key}
+                SA2 Regions: {len(sa2_members)}
+                Population: {round(populations[key])}
+                Click to expand
+                """,
+                "size": 15 + 45 * math.sqrt(populations[key] / max_population) if max_population > 0 else 15,
+                "color": colors["SA2"],
+                "x": center["x"],
+                "y": center["y"]
+                })
+
+        # Initiate PyVis network object, the positions are fixed so the browser does not simulate anything
+        network = self.network(height)
+        network.nodes = nodes
+        network.edges = graph["edges"]
+        network.toggle_physics(False)
+
+        return network.generate_html().replace(
+            NETWORK_CREATED, NETWORK_CREATED + self.cluster_script(clusters), 1
+            )
+
+    @staticmethod
+    def cluster_nodes(graph: dict, cluster_by: str) -> dict:
+        # Group SA2 regions on their closest hospital or the state of that hospital,
+        # hospitals are put in their own group so they end up next to their SA2 regions
+        states = {node["id"]: node.get("state") for node in graph["nodes"] if node["node_type"] == "Hospital"}
+        groups = {}
+        for node in graph["nodes"]:
+            if node["node_type"] == "Hospital":
+                key = node["id"] if cluster_by == "nearest" else node.get("state")
+            else:
+                nearest = node.get("nearest_hospital")
+                key = nearest if cluster_by == "nearest" else states.get(nearest)
+            groups.setdefault(str(key) if key is not None else "Unconnected", []).append(node)
+
+        # Hospitals first, so they are placed in the middle of their group
+        for members in groups.values():
+            members.sort(key=lambda node: node["node_type"] != "Hospital")
+        return groups
+
+    @staticmethod
+    def cluster_layout(groups: dict, spacing: float = 40) -> dict:
+        # Place the groups on a sunflower spiral, largest first, with an area proportional to their size,
+        # and the members of each group on a smaller sunflower around the group center
+        golden_angle = math.pi * (3 - math.sqrt(5))
+        positions = {}
+        placed = 0
+        ordered = sorted(groups.items(), key=lambda item: (-len(item[1]), item[0]))
+        for index, (key, members) in enumerate(ordered):
+            radius = 2 * spacing * math.sqrt(placed + len(members) / 2)
+            center_x = radius * math.cos(index * golden_angle)
+            center_y = radius * math.sin(index * golden_angle)
+            for member_index, node in enumerate(members):
+                member_radius = spacing * math.sqrt(member_index)
+                positions[node["id"]] = {
+                    "x": round(center_x + member_radius * math.cos(member_index * golden_angle), 1),
+                    "y": round(center_y + member_radius * math.sin(member_index * golden_angle), 1)
+                    }
+            placed += len(members)
+        return positions
+
+    @staticmethod
+    def cluster_script(clusters: list) -> str:
+        # Collapse the SA2 regions of every group into a super-node, clicking it opens the cluster again
+        return f"""
+                  var clusters = {json.dumps(clusters)};
+                  clusters.forEach(function(cluster) {{
+                      network.cluster({{
+                          joinCondition: function(nodeOptions) {{
+                              return nodeOptions.cluster === cluster.key && nodeOptions.node_type === "SA2";
+                          }},
+                          clusterNodeProperties: {{
+                              id: "cluster:" + cluster.key,
+                              label: cluster.label,
+                              title: cluster.title,
+                              shape: "dot",
+                              size: cluster.size,
+                              color: cluster.color,
+                              x: cluster.x,
+                              y: cluster.y
+                          }}
+                      }});
+                  }});
+                  network.on("selectNode", function(params) {{
+                      if (params.nodes.length === 1 && network.isCluster(params.nodes[0])) {{
+                          network.openCluster(params.nodes[0]);
+                      }}
+                  }});
+"""
+
+    @staticmethod
+    def fingerprint(value) -> str:
+        # Frames are hashed on their values, anything else on its JSON
+        if not isinstance(value, dict) or not any(hasattr(item, "columns") for item in value.values()):
+            return hashlib.sha1(json.dumps(value, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+        
+        import pandas as pd
+
+        digest = hashlib.sha1()
+        for name in sorted(value):
+            item = value[name]
+            digest.update(str(name).encode("utf-8"))
+            if not hasattr(item, "columns"):
+                digest.update(json.dumps(item, default=str).encode("utf-8"))
+                continue
+            digest.update(json.dumps(list(map(str, item.columns))).encode("utf-8"))
+            try:
+                digest.update(pd.util.hash_pandas_object(item, index=False).to_numpy().tobytes())
+            except TypeError:
+                # Columns holding lists or maps
+                digest.update(item.to_json(orient="values", default_handler=str).encode("utf-8"))
+        return digest.hexdigest()
+
+    @classmethod
+    def _cache_get(cls, cache: OrderedDict, key):
+        with cls._lock:
+            if key not in cache:
+                return None
+            cache.move_to_end(key)
+            return cache[key]
 
-        # Load HTML file in HTML component for display on Streamlit page
-        components.html(HtmlFile.read(), height=height)
\ No newline at end of file
+    @classmethod
+    def _cache_put(cls, cache: OrderedDict, key, value, max_entries: int):
+        with cls._lock:
+            cache[key] = value
+            cache.move_to_end(key)
+            while len(cache) > max_entries:
+                cache.popitem(last=False)